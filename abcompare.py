@@ -0,0 +1,397 @@
+# A/B comparison of two ITM/DWT trace captures
+#
+# Compares the behaviour of two firmware builds (or configurations) from
+# SWO captures of each. Both captures are decoded in parallel (see
+# swo.py) through the same PktCtx packet parser, with subscribers
+# reducing the packets to fixed size streaming summaries:
+#
+#  - exception durations (entry to exit, per exception number)
+#  - CPU sleep fraction and PC sample hotspots
+#  - ITM per-port throughput
+#  - DWT event counter rates per window
+#
+# A report of the distribution level differences (count, mean and
+# percentiles, plus the Kolmogorov-Smirnov distance between the two
+# distributions) is then written. Captures are decoded in windows of
+# edges and the summaries use log-scale histograms, so memory use is
+# bounded however long the captures are.
+#
+# Example usage:
+#
+#  $ python abcompare.py old.bin,stream=1 new.bin,stream=1 --elf new.elf
+#
+# Capture options are as for merge.py sources (stream, offset and baud).
+
+import argparse
+import bisect
+import math
+import multiprocessing
+import struct
+import sys
+from collections import Counter
+
+from debug import DWT_COUNTER_NAMES, DWTCounters, ElfFile, PktKind
+from merge import MergeSource
+from swo import SWODecoder, decode_nrz_windows, estimate_baud, load_edges
+
+# Histogram resolution in bins per doubling of value:
+HIST_BINS_PER_OCTAVE = 8
+HIST_ZERO = -(1 << 30) # bin for zero (and negative) values
+
+# Maximum tracked exception nesting depth:
+EXC_MAX_DEPTH = 64
+
+# Default PC sample bucket size (when no ELF symbols are available):
+PC_BUCKET_SHIFT = 4
+
+# Number of hotspots listed in the report:
+REPORT_HOTSPOTS = 20
+
+#------------------------------------------------------------------------------
+# Streaming summaries
+
+class LogHistogram:
+    # Fixed relative resolution histogram of positive values
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        if value > 0:
+            key = math.floor(math.log2(value) * HIST_BINS_PER_OCTAVE)
+        else:
+            key = HIST_ZERO
+        self.counts[key] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return (self.total / self.count)
+
+    def quantile(self, q):
+        # Returns the (bin centre) value at quantile q
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if seen >= target:
+                if key == HIST_ZERO:
+                    return 0.0
+                value = 2.0 ** ((key + 0.5) / HIST_BINS_PER_OCTAVE)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def cdf(self, keys):
+        cumulative = []
+        seen = 0
+        for key in keys:
+            seen += self.counts.get(key, 0)
+            cumulative.append(seen / self.count)
+        return cumulative
+
+def ks_distance(hist_a, hist_b):
+    # Kolmogorov-Smirnov statistic (to the histogram resolution)
+    if hist_a.count == 0 or hist_b.count == 0:
+        return None
+    keys = sorted(set(hist_a.counts) | set(hist_b.counts))
+    return max(abs(a - b) for (a, b) in zip(hist_a.cdf(keys), hist_b.cdf(keys)))
+
+class CaptureSummary:
+    def __init__(self, tag, window, pc_shift, functions=None):
+        self.tag = tag
+        self.start_time = None
+        self.end_time = None
+        self.nbytes = 0
+        self.errors = 0
+        self.overflows = 0
+        # Exceptions:
+        self.exc_stack = []
+        self.exc_durations = {}
+        self.exc_lost = 0
+        # PC samples:
+        self.pc_shift = pc_shift
+        self.functions = functions
+        self.pc_samples = 0
+        self.pc_sleep = 0
+        self.pc_hist = Counter()
+        # ITM ports : packets and bytes
+        self.port_packets = Counter()
+        self.port_bytes = Counter()
+        # DWT counters:
+        self.counters = DWTCounters(window)
+        self.counter_rates = [LogHistogram() for name in DWT_COUNTER_NAMES]
+
+    def subscribe(self, ctx):
+        ctx.subscribe((PktKind.ITM,), self.itm)
+        ctx.subscribe((PktKind.EXCEPTION,), self.exception)
+        ctx.subscribe((PktKind.PC_SAMPLE,), self.pc_sample)
+        ctx.subscribe((PktKind.WRAP,), self.wrap)
+        ctx.subscribe((PktKind.OVERFLOW,), self.overflow)
+
+    def itm(self, pkt):
+        self.port_packets[pkt.port] += 1
+        self.port_bytes[pkt.port] += pkt.size
+
+    def exception(self, pkt):
+        exception_number = (pkt.data & 0x1FF)
+        fn = ((pkt.data >> 12) & 0x3)
+        if fn == 1:
+            # ENTERED
+            if len(self.exc_stack) == EXC_MAX_DEPTH:
+                del self.exc_stack[0]
+                self.exc_lost += 1
+            self.exc_stack.append( (exception_number, pkt.start_time) )
+        elif fn == 2:
+            # EXITED : match the most recent entry of the exception
+            for idx in range(len(self.exc_stack) - 1, -1, -1):
+                if self.exc_stack[idx][0] == exception_number:
+                    duration = float(pkt.start_time - self.exc_stack[idx][1])
+                    hist = self.exc_durations.get(exception_number)
+                    if hist is None:
+                        hist = LogHistogram()
+                        self.exc_durations[exception_number] = hist
+                    hist.add(duration)
+                    # Any entries above it were missed exits:
+                    self.exc_lost += (len(self.exc_stack) - 1 - idx)
+                    del self.exc_stack[idx:]
+                    break
+
+    def pc_sample(self, pkt):
+        self.pc_samples += 1
+        if pkt.size == 1:
+            self.pc_sleep += 1
+            return
+        if self.functions is not None:
+            self.pc_hist[self.functions.lookup(pkt.data)] += 1
+        else:
+            self.pc_hist[(pkt.data >> self.pc_shift) << self.pc_shift] += 1
+
+    def wrap(self, pkt):
+        if self.counters.wrap_packet(pkt) is not None:
+            (end_time, rates) = self.counters.series[-1]
+            for idx in range(len(DWT_COUNTER_NAMES)):
+                self.counter_rates[idx].add(rates[idx])
+
+    def overflow(self, pkt):
+        # Packets (possibly exception exits) have been lost
+        self.overflows += 1
+        self.exc_lost += len(self.exc_stack)
+        self.exc_stack = []
+
+    def duration(self):
+        if self.start_time is None:
+            return 0.0
+        return float(self.end_time - self.start_time)
+
+#------------------------------------------------------------------------------
+# PC to function mapping
+
+class FunctionMap:
+    def __init__(self, elf):
+        # Cortex-M (32-bit) ELF FUNC symbols from the .symtab section:
+        if elf.is64:
+            raise ValueError('64-bit ELF not supported')
+        symtab = elf.section('.symtab')
+        idx = elf.names.get('.symtab')
+        if not symtab or idx is None:
+            raise ValueError('no .symtab section')
+        stroff = elf.sections[elf.sections[idx][6]][4]
+        functions = {}
+        for (name, value, size, info, other, shndx) in struct.iter_unpack(elf.endian + 'IIIBBH', symtab):
+            if (info & 0xF) == 2 and value:
+                # STT_FUNC (with the Thumb bit cleared):
+                functions[value & ~1] = (elf.cstring(stroff + name), size)
+        self.starts = sorted(functions)
+        self.functions = [functions[start] for start in self.starts]
+
+    def lookup(self, pc):
+        idx = bisect.bisect_right(self.starts, pc) - 1
+        if idx >= 0:
+            (name, size) = self.functions[idx]
+            if pc < self.starts[idx] + max(size, 1):
+                return name
+        return '?{0:08X}'.format(pc)
+
+#------------------------------------------------------------------------------
+# Capture decoding
+
+def summarise(source, window, pc_shift, elf_path):
+    # Worker process : decode a capture into its CaptureSummary
+    functions = None
+    if elf_path:
+        with open(elf_path, 'rb') as fh:
+            functions = FunctionMap(ElfFile(fh.read()))
+    summary = CaptureSummary(source.tag, window, pc_shift, functions)
+    initial_state, begin_time, times = load_edges(source.capture)
+    baud = source.baud
+    if not baud:
+        baud = estimate_baud(times)
+    decoder = SWODecoder(None, 0, source.stream, source.offset)
+    summary.subscribe(decoder.ctx)
+    for (data, starts, ends, errors) in decode_nrz_windows(initial_state, times, baud):
+        if len(data) == 0:
+            continue
+        if summary.start_time is None:
+            summary.start_time = float(starts[0])
+        summary.end_time = float(ends[-1])
+        summary.nbytes += len(data)
+        decoder.feed(data, starts, ends, errors)
+    summary.errors = decoder.ctx.errors
+    # The counters are no longer needed (and the rates are held in
+    # counter_rates), and the exception stack is incomplete:
+    summary.counters = None
+    summary.exc_stack = []
+    summary.functions = None
+    return summary
+
+def compare(source_a, source_b, window=1.0, pc_shift=PC_BUCKET_SHIFT, elf_a=None, elf_b=None):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(2) as pool:
+        result_a = pool.apply_async(summarise, (source_a, window, pc_shift, elf_a))
+        result_b = pool.apply_async(summarise, (source_b, window, pc_shift, elf_b))
+        return (result_a.get(), result_b.get())
+
+#------------------------------------------------------------------------------
+# Report
+
+def fmt_value(value, scale=1.0, spec='{0:.3f}'):
+    if value is None:
+        return '-'
+    if scale != 1.0:
+        value *= scale
+    return spec.format(value)
+
+def fmt_delta(value_a, value_b, scale=1.0):
+    if value_a is None or value_b is None:
+        return '-'
+    if isinstance(value_a, int) and isinstance(value_b, int) and scale == 1.0:
+        delta = '{0:+d}'.format(value_b - value_a)
+    else:
+        delta = '{0:+.3f}'.format((value_b - value_a) * scale)
+    if value_a:
+        delta += ' ({0:+.1f}%)'.format(100.0 * (value_b - value_a) / value_a)
+    return delta
+
+def hist_rows(label, hist_a, hist_b, scale):
+    rows = []
+    stats = (
+        ('count', lambda h: h.count, 1.0, '{0:d}'),
+        ('mean', LogHistogram.mean, scale, '{0:.3f}'),
+        ('p50', lambda h: h.quantile(0.5), scale, '{0:.3f}'),
+        ('p90', lambda h: h.quantile(0.9), scale, '{0:.3f}'),
+        ('p99', lambda h: h.quantile(0.99), scale, '{0:.3f}'),
+        ('max', lambda h: h.max, scale, '{0:.3f}')
+    )
+    for (name, stat, sscale, spec) in stats:
+        value_a = stat(hist_a)
+        value_b = stat(hist_b)
+        rows.append('  {0:<16s} {1:>6s} {2:>14s} {3:>14s} {4:>22s}'.format(label, name, fmt_value(value_a, sscale, spec), fmt_value(value_b, sscale, spec), fmt_delta(value_a, value_b, sscale)))
+        label = ''
+    ks = ks_distance(hist_a, hist_b)
+    rows.append('  {0:<16s} {1:>6s} {2:>14s}'.format('', 'KS', fmt_value(ks)))
+    return rows
+
+def report(summary_a, summary_b, out=sys.stdout):
+    lines = []
+    header = '  {0:<16s} {1:>6s} {2:>14s} {3:>14s} {4:>22s}'.format('', '', summary_a.tag, summary_b.tag, 'delta')
+    lines.append('Capture')
+    lines.append(header)
+    for (name, stat, spec) in (('duration (s)', CaptureSummary.duration, '{0:.3f}'), ('bytes', lambda s: s.nbytes, '{0:d}'), ('framing errors', lambda s: s.errors, '{0:d}'), ('overflows', lambda s: s.overflows, '{0:d}'), ('lost exits', lambda s: s.exc_lost, '{0:d}')):
+        value_a = stat(summary_a)
+        value_b = stat(summary_b)
+        lines.append('  {0:<16s} {1:>6s} {2:>14s} {3:>14s} {4:>22s}'.format(name, '', fmt_value(value_a, 1.0, spec), fmt_value(value_b, 1.0, spec), fmt_delta(value_a, value_b)))
+
+    lines.append('')
+    lines.append('CPU sleep (fraction of PC samples)')
+    sleep = []
+    for summary in (summary_a, summary_b):
+        sleep.append((summary.pc_sleep / summary.pc_samples) if summary.pc_samples else None)
+    lines.append('  {0:<16s} {1:>6s} {2:>14s} {3:>14s} {4:>22s}'.format('sleep', '', fmt_value(sleep[0]), fmt_value(sleep[1]), fmt_delta(sleep[0], sleep[1])))
+
+    lines.append('')
+    lines.append('Exception durations (us)')
+    lines.append(header)
+    empty = LogHistogram()
+    for exception_number in sorted(set(summary_a.exc_durations) | set(summary_b.exc_durations)):
+        lines += hist_rows('EXC {0:d}'.format(exception_number), summary_a.exc_durations.get(exception_number, empty), summary_b.exc_durations.get(exception_number, empty), 1e6)
+
+    lines.append('')
+    lines.append('PC sample hotspots (share of active samples, largest changes)')
+    lines.append(header)
+    total_a = sum(summary_a.pc_hist.values())
+    total_b = sum(summary_b.pc_hist.values())
+    shares = []
+    for key in set(summary_a.pc_hist) | set(summary_b.pc_hist):
+        share_a = (summary_a.pc_hist.get(key, 0) / total_a) if total_a else 0.0
+        share_b = (summary_b.pc_hist.get(key, 0) / total_b) if total_b else 0.0
+        shares.append( (abs(share_b - share_a), key, share_a, share_b) )
+    shares.sort(key=lambda item: item[0], reverse=True)
+    for (change, key, share_a, share_b) in shares[:REPORT_HOTSPOTS]:
+        if isinstance(key, int):
+            key = '{0:08X}'.format(key)
+        lines.append('  {0:<23s} {1:>14s} {2:>14s} {3:>22s}'.format(key[:23], fmt_value(share_a), fmt_value(share_b), fmt_delta(share_a, share_b)))
+    if total_a and total_b:
+        # Total variation distance between the two PC distributions:
+        tvd = sum(item[0] for item in shares) / 2.0
+        lines.append('  {0:<23s} {1:>14s}'.format('total variation', fmt_value(tvd)))
+
+    lines.append('')
+    lines.append('ITM port throughput (bytes/s)')
+    lines.append(header)
+    for port in sorted(set(summary_a.port_bytes) | set(summary_b.port_bytes)):
+        rates = []
+        for summary in (summary_a, summary_b):
+            duration = summary.duration()
+            rates.append((summary.port_bytes.get(port, 0) / duration) if duration else None)
+        lines.append('  {0:<16s} {1:>6s} {2:>14s} {3:>14s} {4:>22s}'.format('Port#{0:d}'.format(port), '', fmt_value(rates[0]), fmt_value(rates[1]), fmt_delta(rates[0], rates[1])))
+
+    lines.append('')
+    lines.append('DWT counter rates (per window, per second)')
+    lines.append(header)
+    for idx in range(len(DWT_COUNTER_NAMES)):
+        hist_a = summary_a.counter_rates[idx]
+        hist_b = summary_b.counter_rates[idx]
+        if hist_a.total or hist_b.total:
+            lines += hist_rows(DWT_COUNTER_NAMES[idx], hist_a, hist_b, 1.0)
+
+    out.write('\n'.join(lines) + '\n')
+
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the ITM/DWT behaviour of two SWO captures')
+    parser.add_argument('a', help='baseline CAPTURE[,option=value...]')
+    parser.add_argument('b', help='comparison CAPTURE[,option=value...]')
+    parser.add_argument('--elf', help='ELF file for PC sample function names (both captures)')
+    parser.add_argument('--elf-a', help='ELF file for capture A')
+    parser.add_argument('--elf-b', help='ELF file for capture B')
+    parser.add_argument('--window-ms', type=float, default=1000.0, help='DWT counter rate window')
+    parser.add_argument('--pc-shift', type=int, default=PC_BUCKET_SHIFT, help='log2 PC bucket size without ELF symbols')
+    args = parser.parse_args(argv)
+
+    try:
+        source_a = MergeSource('A=' + args.a)
+        source_b = MergeSource('B=' + args.b)
+    except (ValueError, KeyError) as ex:
+        parser.error(str(ex))
+    elf_a = args.elf_a or args.elf
+    elf_b = args.elf_b or args.elf
+    (summary_a, summary_b) = compare(source_a, source_b, (args.window_ms / 1000.0), args.pc_shift, elf_a, elf_b)
+    report(summary_a, summary_b)
+
+if __name__ == '__main__':
+    main()
+
+#------------------------------------------------------------------------------
+#> EOF abcompare.py
@@ -6,28 +6,63 @@
 
 # See ARMv7-M Architecture Reference Manual Appendix D4 for packet encoding
 
-from saleae.analyzers import HighLevelAnalyzer, AnalyzerFrame, StringSetting, NumberSetting, ChoicesSetting
+try:
+    from saleae.analyzers import HighLevelAnalyzer, AnalyzerFrame, StringSetting, NumberSetting, ChoicesSetting
+except ImportError:
+    # Outside of Logic2 (e.g. the offline swo.py decoder) the packet
+    # decoding classes only need a frame container, with times held as
+    # float seconds. The analyser setting classes are just placeholders.
+    class AnalyzerFrame:
+        def __init__(self, type, start_time, end_time, data=None):
+            self.type = type
+            self.start_time = start_time
+            self.end_time = end_time
+            self.data = data
+
+    class HighLevelAnalyzer:
+        pass
+
+    class StringSetting:
+        def __init__(self, **kwargs):
+            pass
+
+    NumberSetting = StringSetting
+    ChoicesSetting = StringSetting
+
 from enum import IntEnum
+import hashlib
+import re
+import struct
+from collections import deque
 
 class TPIU_FSM(IntEnum):
-    HDR = 255 # waiting for header byte
-    # ITM (instrumentation)
-    ITM1 = 1
-    ITM2 = 2
-    ITM3 = 3
-    ITM4 = 4
-    # DWT (hardware)
-    DWT1 = 5
-    DWT2 = 6
-    DWT3 = 7
-    DWT4 = 8
+    HDR = 0 # waiting for header byte
+    # ITM (instrumentation) payload bytes
+    ITM = 1
+    # DWT (hardware) payload bytes
+    DWT = 2
     # EXT (extension)
-    EXT = 9
+    EXT = 3
     # LTS (Local TimeStamp)
-    LTS = 10
+    LTS = 4
     # GTS (Global TimeStamp)
-    GTS1 = 11
-    GTS2 = 12
+    GTS1 = 5
+    GTS2 = 6
+
+# Index of the last byte (after the header) of each variable length
+# continuation packet, and the error reported if that byte still has
+# its (C)ontinuation bit set:
+CONT_LAST = {
+    TPIU_FSM.EXT: 3,
+    TPIU_FSM.LTS: 3,
+    TPIU_FSM.GTS1: 3,
+    TPIU_FSM.GTS2: 5
+}
+CONT_ERRORS = {
+    TPIU_FSM.LTS: 'Local TimeStamp Continuation',
+    TPIU_FSM.GTS1: 'Global TimeStamp1 Continuation',
+    TPIU_FSM.GTS2: 'Global TimeStamp2 Continuation'
+}
 
 # ITM/DWT decoding
 class DecodeStyle(IntEnum):
@@ -35,6 +70,9 @@ class DecodeStyle(IntEnum):
     Port = 1 # decode specific port# only
     Console = 2 # decode specific port# as ASCII console
     Instrumentation = 3 # decode specific port# as eCosPro style multi-frame O/S instrumentation
+    Timeline = 4 # analyse specific port# eCosPro instrumentation as RTOS thread timeline
+    Search = 5 # search specific port# console data for trigger patterns
+    Counters = 6 # DWT event counter wrap rates
 
 # TPIU decoding
 class DecodeStyleTPIU(IntEnum):
@@ -42,6 +80,11 @@ class DecodeStyleTPIU(IntEnum):
     Stream = 1 # decode specific stream# only
     Saleae = 2 # internal decode to Saleae frames
 
+# ETM decoding
+class DecodeStyleETM(IntEnum):
+    Packets = 0 # decode ETM packets
+    Execution = 1 # reconstruct executed instruction ranges using the ELF image
+
 # ITM
 # Synchronisation:
 ITMDWTPP_SYNC = 0x00 # Terminated by single set bit after at least 47 bits.
@@ -89,26 +132,270 @@ DWT_ID_PC_SAMPLE = 2
 # 3..7 reserved
 # 8..23 Data tracing
 
+#------------------------------------------------------------------------------
+# Decoded packet events. For each complete packet PktCtx fills in its
+# single PktEvent record and passes it to the handlers subscribed to
+# that kind of packet (and, for ITM packets, that stimulus port). The
+# record is reused for every packet, so a handler must copy any fields
+# it wants to keep. A handler returns None, an AnalyzerFrame or a list
+# of AnalyzerFrames, which become the decoded output.
+
+class PktKind(IntEnum):
+    ITM = 0 # port, size and data
+    PC_SAMPLE = 1 # size and data (size 1 for a sleeping CPU)
+    EXCEPTION = 2 # data : ExceptionNumber in bits 0..8 and FN in bits 12..13
+    WRAP = 3 # data : event counter wrap bits
+    DWT = 4 # code (discriminator ID), size and data of other hardware packets
+    EXTENSION = 5 # data
+    LOCAL_TS = 6 # code (TC) and data
+    GLOBAL_TS1 = 7 # code (ClkChk and Wrap flags) and data
+    GLOBAL_TS2 = 8 # data
+    SYNC = 9
+    OVERFLOW = 10
+
+# Stimulus port addresses (8 pages of 32 ports):
+ITM_PORTS = 256
+
+class PktEvent:
+    __slots__ = ('kind', 'start_time', 'end_time', 'port', 'code', 'size', 'data')
+
+    def __init__(self):
+        self.kind = None
+        self.start_time = None
+        self.end_time = None
+        self.port = 0
+        self.code = 0
+        self.size = 0
+        self.data = 0
+
+#------------------------------------------------------------------------------
+# Minimal ELF reader. We only need section contents so a small struct
+# based parser avoids depending on external tools or packages that are
+# not available in the Saleae python world.
+
+class ElfFile:
+    def __init__(self, image):
+        self.image = image
+        if len(image) < 52 or image[0:4] != b'\x7fELF':
+            raise ValueError('Not an ELF file')
+        self.is64 = (image[4] == 2)
+        self.endian = '<' if image[5] == 1 else '>'
+        (self.machine,) = struct.unpack_from(self.endian + 'H', image, 18)
+        if self.is64:
+            if len(image) < 64:
+                raise ValueError('Truncated ELF header')
+            (shoff,) = struct.unpack_from(self.endian + 'Q', image, 40)
+            shentsize, shnum, shstrndx = struct.unpack_from(self.endian + 'HHH', image, 58)
+            shfmt = self.endian + 'IIQQQQIIQQ'
+        else:
+            (shoff,) = struct.unpack_from(self.endian + 'I', image, 32)
+            shentsize, shnum, shstrndx = struct.unpack_from(self.endian + 'HHH', image, 46)
+            shfmt = self.endian + 'IIIIIIIIII'
+        # A corrupt header must not index outside the image (or the
+        # section table):
+        if shnum and (shentsize < struct.calcsize(shfmt) or (shoff + (shnum * shentsize)) > len(image)):
+            raise ValueError('Bad section header table')
+        if shnum and shstrndx >= shnum:
+            raise ValueError('Bad section name table index {0:d}'.format(shstrndx))
+        # Section headers as (name_offset, type, flags, addr, offset, size, link, info, align, entsize):
+        self.sections = []
+        for idx in range(shnum):
+            self.sections.append(struct.unpack_from(shfmt, image, shoff + (idx * shentsize)))
+        self.names = {}
+        if shnum:
+            stroff = self.sections[shstrndx][4]
+            if stroff >= len(image):
+                raise ValueError('Bad section name table offset')
+            for idx in range(shnum):
+                self.names[self.cstring(stroff + self.sections[idx][0])] = idx
+
+    def cstring(self, offset):
+        end = self.image.index(b'\x00', offset)
+        return self.image[offset:end].decode('ascii', 'replace')
+
+    def section(self, name):
+        idx = self.names.get(name)
+        if idx is None:
+            return None
+        sh = self.sections[idx]
+        if sh[1] == 8: # SHT_NOBITS
+            return b''
+        return self.image[sh[4]:sh[4] + sh[5]]
+
 #------------------------------------------------------------------------------
 # Normally we would extract the format of the instrumentation records
 # as embedded in the (non-loaded) ELF sections using a suitable
 # tool. For example, instdump:
 #
 #  $ instdump fpint_thread_switch
-
-# ASCERTAIN: Does the Saleae python world allow arbitrary command
-# execution (a security risk, but we would need the feature to be able
-# to use external tools)
+#
+# Rather than executing an external tool we read a (non-loaded)
+# descriptor section directly from the ELF file. NOTE: this is an
+# assumed format defined by this analyser, not the encoding of the
+# eCosPro instrumentation descriptors as read by instdump (which is not
+# documented here); the application build must emit the section in
+# this form. Each descriptor is encoded (in the ELF endianness) as:
+#
+#  u16 id         record class/type : (class << 8) | type
+#  u8  nfields
+#  u8  namelen
+#  u8  name[namelen]
+#  nfields * {
+#    u8  word     body word index
+#    u8  shift    LSB bit position in word
+#    u8  width    field width in bits
+#    u8  namelen
+#    u8  name[namelen]
+#    u8  nenum    number of enumeration entries
+#    nenum * {
+#      u32 value
+#      u8  namelen
+#      u8  name[namelen]
+#    }
+#  }
+#
+# with each descriptor padded to a 4-byte boundary. The record id is
+# held in the low 16-bits of the first body word of every record (as
+# per the eCos Instrument_Record type field).
+
+INST_DESC_SECTION = '.ecos.inst.desc'
+
+class InstLayout:
+    # Precompiled record layout: fields is a tuple of
+    # (name, word, shift, mask, enums) with enums either None or a dict
+    # mapping values to names.
+    def __init__(self, rid, name, fields):
+        self.rid = rid
+        self.name = name
+        self.fields = fields
+
+    def decode(self, dvector, num_words):
+        data_str = self.name
+        for (fname, word, shift, mask, enums) in self.fields:
+            if word >= num_words:
+                data_str += ' {0:s}=?'.format(fname)
+                continue
+            val = ((dvector[word] >> shift) & mask)
+            if enums is not None and val in enums:
+                data_str += ' {0:s}={1:s}'.format(fname, enums[val])
+            else:
+                data_str += ' {0:s}={1:X}'.format(fname, val)
+        return data_str
+
+def inst_parse_descriptors(desc, endian='<'):
+    # Raises ValueError if a descriptor is truncated
+
+    def need(offset, count):
+        if (offset + count) > len(desc):
+            raise ValueError('Truncated {0:s} descriptor at offset {1:d}'.format(INST_DESC_SECTION, rstart))
+
+    layouts = {}
+    offset = 0
+    while (offset + 4) <= len(desc):
+        rstart = offset
+        rid, nfields, nlen = struct.unpack_from(endian + 'HBB', desc, offset)
+        offset += 4
+        if rid == 0 and nfields == 0 and nlen == 0:
+            # Section padding
+            continue
+        need(offset, nlen)
+        name = desc[offset:offset + nlen].decode('ascii', 'replace')
+        offset += nlen
+        fields = []
+        for fidx in range(nfields):
+            need(offset, 4)
+            word, shift, width, flen = struct.unpack_from('BBBB', desc, offset)
+            offset += 4
+            need(offset, flen + 1)
+            fname = desc[offset:offset + flen].decode('ascii', 'replace')
+            offset += flen
+            nenum = desc[offset]
+            offset += 1
+            enums = None
+            if nenum:
+                enums = {}
+                for eidx in range(nenum):
+                    need(offset, 5)
+                    (value,) = struct.unpack_from(endian + 'I', desc, offset)
+                    elen = desc[offset + 4]
+                    offset += 5
+                    need(offset, elen)
+                    enums[value] = desc[offset:offset + elen].decode('ascii', 'replace')
+                    offset += elen
+            fields.append( (fname, word, shift, ((1 << width) - 1), enums) )
+        layouts[rid] = InstLayout(rid, name, tuple(fields))
+        offset = rstart + (((offset - rstart) + 3) & ~3)
+    return layouts
+
+# Layouts are cached against the ELF contents hash so that multiple
+# analyser instances (or re-runs) referencing the same application do
+# not re-parse the descriptors:
+_inst_layout_cache = {}
+
+def inst_load_layouts(elf_path):
+    with open(elf_path, 'rb') as fh:
+        image = fh.read()
+    key = hashlib.sha1(image).hexdigest()
+    layouts = _inst_layout_cache.get(key)
+    if layouts is None:
+        elf = ElfFile(image)
+        desc = elf.section(INST_DESC_SECTION)
+        if desc is None:
+            # Otherwise every record would silently be shown raw:
+            raise ValueError('no {0:s} section'.format(INST_DESC_SECTION))
+        layouts = {}
+        if desc:
+            layouts = inst_parse_descriptors(desc, elf.endian)
+        _inst_layout_cache[key] = layouts
+    return layouts
+
+# The header NN field is 8-bits so a record never has more than 255
+# body words. Each assembler grows (and then recycles) a single record
+# buffer sized from the header NN value, so a long capture does not
+# churn list objects, and a corrupt header or missing tail can never
+# cause unbounded growth while we wait for the tail.
 
 class Instrumentation:
-    def __init__(self):
+    def __init__(self, layouts=None, port=None, consumer=None):
+        self.layouts = layouts
+        self.port = port
+        self.consumer = consumer
         self.start_time = None
         self.end_time = 0
         self.sequence = 256
-        self.lastseq = 0
+        self.lastseq = None
         self.rec_words = 0
         self.num_words = 0
         self.dvector = []
+        self.pending = False
+        # Cumulative statistics:
+        self.records = 0
+        self.missed = 0
+        self.partial = 0
+        self.oversize = 0
+        self.unknown = 0 # records without a layout (when layouts are known)
+
+    def prefix(self):
+        if self.port is None:
+            return ''
+        return 'Port#{0:d} '.format(self.port)
+
+    def stats(self):
+        return 'records {0:d} missed {1:d} partial {2:d} oversize {3:d} unknown {4:d}'.format(self.records, self.missed, self.partial, self.oversize, self.unknown)
+
+    def loss(self, data_str):
+        # Frames reporting a lost, partial or malformed record carry the
+        # cumulative counts:
+        return data_str + ' [' + self.stats() + ']'
+
+    def flush(self, now, hold):
+        # Mark (once) a record whose tail has not arrived within the hold
+        # time, so the user is not left wondering about a missing record:
+        if self.sequence == 256 or self.pending or float(now - self.end_time) < hold:
+            return None
+        self.pending = True
+        data_str = self.prefix() + 'Seq#{0:02X} pending (fields {1:d} of {2:d})'.format(self.sequence, self.num_words, self.rec_words)
+        return AnalyzerFrame('pending', self.start_time, self.end_time, {'val': data_str })
 
     def packet(self, start_time, end_time, size, pdata):
         if size == 1:
@@ -116,22 +403,48 @@ class Instrumentation:
             snum = (pdata & 0xFF)
             nf = None
             if self.sequence != snum:
-                data_str = 'Seq# mismatch: saw {0:02X} expected {1:02X}'.format(snum, self.sequence)
+                self.partial += 1
+                data_str = self.loss(self.prefix() + 'Seq# mismatch: saw {0:02X} expected {1:02X}'.format(snum, self.sequence))
                 use_start = self.start_time
                 if use_start == None:
                     use_start = start_time
                 nf = AnalyzerFrame('err', use_start, end_time, {'val': data_str })
             else:
-                data_str = ''
-                if snum != ((self.lastseq + 1) & 0xFF):
-                    # CONSIDER: Reporting count of "at least # missed"
-                    data_str += '[Missed packets] '
+                self.records += 1
+                data_str = self.prefix()
+                lossy = False
+                if self.lastseq is not None:
+                    # The sequence# is modulo-256 so we can only report
+                    # the minimum number of records lost:
+                    gap = ((snum - self.lastseq - 1) & 0xFF)
+                    if gap:
+                        self.missed += gap
+                        lossy = True
+                        data_str += '[Missed {0:d} (total {1:d})] '.format(gap, self.missed)
                 data_str += 'Seq#{0:02X}'.format(self.sequence)
                 if self.rec_words != self.num_words:
                     data_str += '[Fields saw {0:d} expected {1:d}] '.format(self.num_words, self.rec_words)
-                for idx in range(self.num_words):
-                    data_str += ' {0:08X}'.format(self.dvector[idx])
-                nf = AnalyzerFrame('console', self.start_time, end_time, {'val': data_str })
+                    if self.num_words > self.rec_words:
+                        self.oversize += 1
+                    lossy = True
+                num_words = min(self.num_words, self.rec_words)
+                if self.consumer is not None:
+                    # Record analysis replaces the per-record output:
+                    nf = self.consumer.record(self.start_time, end_time, self.dvector, num_words)
+                else:
+                    layout = None
+                    if self.layouts and num_words:
+                        layout = self.layouts.get(self.dvector[0] & 0xFFFF)
+                        if layout is None:
+                            self.unknown += 1
+                    if layout is not None:
+                        data_str += ' ' + layout.decode(self.dvector, num_words)
+                    else:
+                        for idx in range(num_words):
+                            data_str += ' {0:08X}'.format(self.dvector[idx])
+                    if lossy:
+                        data_str = self.loss(data_str)
+                    nf = AnalyzerFrame('console', self.start_time, end_time, {'val': data_str })
             self.lastseq = snum
             self.sequence = 256
             return nf
@@ -140,154 +453,466 @@ class Instrumentation:
             nf = None
             if self.sequence != 256:
                 # If active (non-tail) record then return "error frame" for output
-                data_str = 'Partial record for seq# {0:02X}'.format(self.sequence)
+                self.partial += 1
+                data_str = self.loss(self.prefix() + 'Partial record for seq# {0:02X}'.format(self.sequence))
                 use_start = self.start_time
                 if use_start == None:
                     use_start = start_time
                 nf = AnalyzerFrame('err', use_start, self.end_time, {'val': data_str })
             # new record:
+            self.pending = False
             self.num_words = 0
             self.sequence = (pdata & 0xFF)
             self.rec_words = ((pdata >> 8) & 0xFF)
             self.start_time = start_time
             self.end_time = end_time
-            self.dvector = []
+            if len(self.dvector) < self.rec_words:
+                self.dvector.extend([0] * (self.rec_words - len(self.dvector)))
             return nf
         elif size == 4:
             # data
-            self.dvector.append(pdata)
+            if self.sequence == 256:
+                # No active record : nowhere to store the field
+                return None
+            if self.num_words < self.rec_words:
+                self.dvector[self.num_words] = pdata
+            # Words beyond the declared record size are counted (and
+            # reported at the tail) but not stored:
             self.num_words += 1
             self.end_time = end_time
             return None
         else:
             # Unexpected size : return error frame
-            data_str = 'Unexpected field size {0:d}'.format(size)
+            if self.sequence != 256:
+                self.partial += 1
+            data_str = self.loss(self.prefix() + 'Unexpected field size {0:d}'.format(size))
             self.sequence = 256
             use_start = self.start_time
             if use_start == None:
                 use_start = start_time
             return AnalyzerFrame('err', use_start, end_time, {'val': data_str })
 
+#------------------------------------------------------------------------------
+# RTOS scheduler timeline from eCos instrumentation records. The body
+# of a record follows the eCos Instrument_Record structure:
+#
+#  word0 : type (class << 8 | event) in bits 0..15 : thread in bits 16..31
+#  word1 : timestamp
+#  word2 : arg1
+#  word3 : arg2
+#
+# For THREAD_SWITCH arg1 is the outgoing and arg2 the incoming thread.
+# For the INTR events arg1 is the interrupt vector.
+#
+# If the frequency of the (32-bit, wrapping) timer used for the record
+# timestamps is known then the timeline is measured from the record
+# timestamps. Otherwise the capture time of each record is used, which
+# is skewed by the SWO transfer time of the record (for example ~150us
+# for a 5-word record at 2MHz) and so also by any queueing behind other
+# trace data. The frames give the timebase used as data.timebase.
+
+INST_THREAD_SWITCH = 0x0201 # CYG_INSTRUMENT_CLASS_THREAD | CYG_INSTRUMENT_EVENT_THREAD_SWITCH
+INST_INTR_RAISE = 0x0301 # CYG_INSTRUMENT_CLASS_INTR | CYG_INSTRUMENT_EVENT_INTR_RAISE
+INST_INTR_END = 0x0302 # CYG_INSTRUMENT_CLASS_INTR | CYG_INSTRUMENT_EVENT_INTR_END
+
+class ThreadStats:
+    def __init__(self):
+        self.cpu_time = 0.0
+        self.switches = 0
+        self.window_time = 0.0
+
+class ThreadTimeline:
+    # Incremental analysis : we only hold per-thread counters (bounded by
+    # the number of threads in the application) and the state of the
+    # current run interval, so memory use is independent of the capture
+    # length. Event times (run_time etc.) are in the timeline timebase,
+    # while frames are placed at the capture times of the records.
+    def __init__(self, window, timer_hz=0):
+        self.window = window # seconds (0 disables summaries)
+        self.timer_hz = timer_hz
+        self.timebase = 'record' if timer_hz else 'arrival'
+        self.last_stamp = None
+        self.ticks = 0 # unwrapped record timestamp
+        self.threads = {}
+        self.current = None
+        self.run_start = None
+        self.run_time = None
+        self.isr_depth = 0
+        self.isr_start = None
+        self.isr_time = 0.0 # ISR time within the current run interval
+        self.last_isr_end = None
+        self.window_start = None
+        self.window_time = None
+        self.window_switches = 0
+        self.window_isr = 0.0
+        self.window_latency = 0.0
+        self.window_latency_max = 0.0
+        self.window_latency_count = 0
+
+    def thread(self, tid):
+        ts = self.threads.get(tid)
+        if ts is None:
+            ts = ThreadStats()
+            self.threads[tid] = ts
+        return ts
+
+    def event_time(self, capture_time, dvector):
+        # Returns the timeline time of a record
+        if not self.timer_hz:
+            return float(capture_time)
+        stamp = dvector[1]
+        if self.last_stamp is not None:
+            self.ticks += ((stamp - self.last_stamp) & 0xFFFFFFFF)
+        self.last_stamp = stamp
+        return (self.ticks / self.timer_hz)
+
+    def summary(self, end_time, now):
+        span = (now - self.window_time)
+        data_str = 'Window {0:.3f}ms: switches {1:d}'.format(span * 1000.0, self.window_switches)
+        if span > 0:
+            data_str += ' ISR {0:.1f}%'.format((self.window_isr * 100.0) / span)
+        if self.window_latency_count:
+            data_str += ' latency avg {0:.1f}us max {1:.1f}us'.format((self.window_latency * 1e6) / self.window_latency_count, self.window_latency_max * 1e6)
+        for tid, ts in sorted(self.threads.items(), key=lambda item: -item[1].window_time):
+            if ts.window_time and span > 0:
+                data_str += ' T{0:X} {1:.1f}%'.format(tid, (ts.window_time * 100.0) / span)
+            ts.window_time = 0.0
+        nf = AnalyzerFrame('summary', self.window_start, end_time, {'val': data_str, 'timebase': self.timebase })
+        self.window_start = end_time
+        self.window_time = now
+        self.window_switches = 0
+        self.window_isr = 0.0
+        self.window_latency = 0.0
+        self.window_latency_max = 0.0
+        self.window_latency_count = 0
+        return nf
+
+    def record(self, start_time, end_time, dvector, num_words):
+        if num_words < 3:
+            return None
+        frames = []
+        rtype = (dvector[0] & 0xFFFF)
+        # Without record timestamps an interrupt is taken to end when its
+        # INTR_END record has arrived:
+        if rtype == INST_INTR_END:
+            now = self.event_time(end_time, dvector)
+        else:
+            now = self.event_time(start_time, dvector)
+        if self.window_start is None:
+            self.window_start = start_time
+            self.window_time = now
+        elif self.window and (now - self.window_time) >= self.window:
+            frames.append(self.summary(start_time, now))
+
+        if rtype == INST_THREAD_SWITCH and num_words >= 4:
+            nthread = dvector[3]
+            if self.current is not None:
+                ts = self.thread(self.current)
+                elapsed = (now - self.run_time)
+                cpu = max(elapsed - self.isr_time, 0.0)
+                ts.cpu_time += cpu
+                ts.window_time += cpu
+                data_str = 'T{0:X} ran {1:.1f}us (cpu {2:.3f}ms switches {3:d})'.format(self.current, cpu * 1e6, ts.cpu_time * 1000.0, ts.switches)
+                frames.append(AnalyzerFrame('thread', self.run_start, start_time, {'val': data_str, 'timebase': self.timebase }))
+            if self.last_isr_end is not None:
+                # Latency from the interrupt that made the thread runnable:
+                latency = (now - self.last_isr_end)
+                self.window_latency += latency
+                self.window_latency_count += 1
+                if latency > self.window_latency_max:
+                    self.window_latency_max = latency
+                self.last_isr_end = None
+            self.thread(nthread).switches += 1
+            self.window_switches += 1
+            self.current = nthread
+            self.run_start = start_time
+            self.run_time = now
+            self.isr_time = 0.0
+        elif rtype == INST_INTR_RAISE:
+            if self.isr_depth == 0:
+                self.isr_start = now
+            self.isr_depth += 1
+        elif rtype == INST_INTR_END:
+            if self.isr_depth:
+                self.isr_depth -= 1
+                if self.isr_depth == 0:
+                    elapsed = (now - self.isr_start)
+                    self.isr_time += elapsed
+                    self.window_isr += elapsed
+                    self.last_isr_end = now
+
+        if len(frames) == 0:
+            return None
+        return frames
+
 #------------------------------------------------------------------------------
 
 class ConsoleCtx:
     def __init__(self, start_time):
         self.start_time = start_time
+        self.end_time = start_time
         self.ctext = ''
+        self.flushed = False
 
-    def cdata(self, frame, cc):
+    def cdata(self, start_time, end_time, cc):
         nf = None
 
         if cc == 0x0A or cc == 0x00:
-            nf = AnalyzerFrame('console', self.start_time, frame.end_time, {'val': self.ctext })
+            # Avoid an empty frame for the terminator of a line that was
+            # already output as partial frames:
+            if self.ctext != '' or not self.flushed:
+                nf = AnalyzerFrame('console', self.start_time, end_time, {'val': self.ctext })
             self.ctext = ''
+            self.flushed = False
         else:
             if self.ctext == '':
-                self.start_time = frame.start_time
+                self.start_time = start_time
             newchr = chr(cc)
             if str(newchr).isprintable():
                 self.ctext += newchr
+            self.end_time = end_time
 
         return nf
 
+    def itm_packet(self, pkt):
+        frames = []
+        for idx in range(pkt.size):
+            nf = self.cdata(pkt.start_time, pkt.end_time, ((pkt.data >> (idx * 8)) & 0xFF))
+            if nf != None:
+                frames.append(nf)
+        return frames
+
+    def flush(self, now, hold):
+        # Output a held partial line once it has been waiting for more
+        # than the hold time:
+        if self.ctext == '' or float(now - self.end_time) < hold:
+            return None
+        nf = AnalyzerFrame('partial', self.start_time, self.end_time, {'val': self.ctext })
+        self.ctext = ''
+        self.flushed = True
+        return nf
+
 #------------------------------------------------------------------------------
+# Console trigger search. Literal patterns are matched with an
+# Aho-Corasick automaton fed one byte at a time, so a single pass over
+# the console data finds every pattern, including matches split across
+# ITM packets (and TPIU frames). Patterns prefixed with "re:" are
+# compiled into a single alternation regex which is applied to each
+# completed console line.
+
+SEARCH_MAX_LINE = 1024 # bound on buffered line length for regex matching
+
+class ConsoleSearch:
+    def __init__(self, patterns):
+        self.names = []
+        self.hits = []
+        literals = []
+        regexes = []
+        for pattern in patterns:
+            if pattern.startswith('re:'):
+                regexes.append( (len(self.names), pattern[3:]) )
+            else:
+                literals.append( (len(self.names), pattern.encode('latin-1')) )
+            self.names.append(pattern)
+            self.hits.append(0)
+
+        # Build the automaton: goto[] dicts, fail[] links and out[] tuples
+        # of (pattern index, pattern length):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+        for (pidx, pbytes) in literals:
+            state = 0
+            for cc in pbytes:
+                nstate = self.goto[state].get(cc)
+                if nstate is None:
+                    nstate = len(self.goto)
+                    self.goto[state][cc] = nstate
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                state = nstate
+            self.out[state] += ( (pidx, len(pbytes)), )
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for cc, nstate in self.goto[state].items():
+                queue.append(nstate)
+                fstate = self.fail[state]
+                while fstate and cc not in self.goto[fstate]:
+                    fstate = self.fail[fstate]
+                fstate = self.goto[fstate].get(cc, 0)
+                if fstate == nstate:
+                    fstate = 0
+                self.fail[nstate] = fstate
+                self.out[nstate] += self.out[fstate]
+        self.state = 0
+
+        # Start times of the most recent bytes so a marker can cover the
+        # whole match:
+        maxlen = 1
+        for (pidx, pbytes) in literals:
+            maxlen = max(maxlen, len(pbytes))
+        self.times = deque(maxlen=maxlen)
+
+        # Each regex is compiled (and applied) on its own so that
+        # overlapping patterns are all counted, and a pattern's groups
+        # and backreferences keep their own numbering:
+        self.regexes = tuple((pidx, re.compile(rx)) for (pidx, rx) in regexes)
+        self.line = bytearray()
+        self.line_start = None
+
+    def marker(self, pidx, start_time, end_time):
+        self.hits[pidx] += 1
+        data_str = '{0:s} (hit {1:d})'.format(self.names[pidx], self.hits[pidx])
+        return AnalyzerFrame('marker', start_time, end_time, {'val': data_str, 'hits': self.stats() })
+
+    def stats(self):
+        return ' '.join('{0:s}={1:d}'.format(name, count) for (name, count) in zip(self.names, self.hits))
+
+    def itm_packet(self, pkt):
+        frames = []
+        for idx in range(pkt.size):
+            nf = self.cdata(pkt.start_time, pkt.end_time, ((pkt.data >> (idx * 8)) & 0xFF))
+            if nf != None:
+                frames += nf
+        return frames
 
-class PktCtx:
-    def __init__(self, start_time, dstyle, portaddr):
-        self.start_time = start_time
-        self.end_time = 0
-        self.portaddr = portaddr
-        self.fsm = TPIU_FSM.HDR
-        self.ipage = 0
-        self.size = 0
-        self.pcode = 0
-        self.pdata = 0
-        self.dstyle = dstyle
-        self.instrumentation = None
-        self.conctx = None
-        self.syncidx = 0
+    def cdata(self, start_time, end_time, cc):
+        nframes = None
+        self.times.append(start_time)
+
+        state = self.state
+        goto = self.goto
+        while state and cc not in goto[state]:
+            state = self.fail[state]
+        state = goto[state].get(cc, 0)
+        self.state = state
+        if self.out[state]:
+            nframes = []
+            for (pidx, plen) in self.out[state]:
+                nframes.append(self.marker(pidx, self.times[-plen], end_time))
+
+        if self.regexes:
+            if cc == 0x0A or cc == 0x00:
+                line = self.line.decode('latin-1')
+                for (pidx, regex) in self.regexes:
+                    for match in regex.finditer(line):
+                        if nframes is None:
+                            nframes = []
+                        nframes.append(self.marker(pidx, self.line_start, end_time))
+                self.line.clear()
+            else:
+                if len(self.line) == 0:
+                    self.line_start = start_time
+                if len(self.line) < SEARCH_MAX_LINE:
+                    self.line.append(cc)
 
-    def itm_process_data(self, frame):
-        #if self.pcode is not 24:
-        #    return
+        return nframes
 
-        data_str = ''
+#------------------------------------------------------------------------------
+# DWT event counter wrap accumulation. Each bit of a wrap packet marks an
+# overflow of the corresponding 8-bit profiling counter (256 events) or
+# of the POSTCNT timer (one POSTCNT period of cycles). We maintain 64-bit
+# totals per counter, and report event rates over fixed windows of
+# capture time.
+
+DWT_COUNTER_NAMES = ('CPI', 'Exc', 'Sleep', 'LSU', 'Fold', 'Cyc') # wrap bits b0..b5
+DWT_COUNTER_CYC = 5
+DWT_SERIES_LEN = 1024 # number of windows of rate history retained
+
+class DWTCounters:
+    def __init__(self, window, postcnt_period=0):
+        self.window = window # seconds
+        # Increment per wrap bit. If the POSTCNT period (in cycles) is
+        # not known the Cyc counter is reported in POSTCNT wraps:
+        self.increment = [256, 256, 256, 256, 256, 1]
+        if postcnt_period:
+            self.increment[DWT_COUNTER_CYC] = postcnt_period
+        self.totals = [0] * len(DWT_COUNTER_NAMES)
+        self.counts = [0] * len(DWT_COUNTER_NAMES)
+        self.window_start = None
+        # Graph friendly (end_time, rates) history:
+        self.series = deque(maxlen=DWT_SERIES_LEN)
+
+    def rates(self, end_time):
+        span = float(end_time - self.window_start)
+        if span <= 0:
+            return None
+        return tuple(count / span for count in self.counts)
 
-        do_tag = 'itm'
-        do_raw = True
+    def flush(self, end_time):
+        rates = self.rates(end_time)
+        nf = None
+        if rates is not None:
+            self.series.append( (end_time, rates) )
+            data_str = ''
+            for idx in range(len(DWT_COUNTER_NAMES)):
+                if self.counts[idx]:
+                    data_str += ' {0:s} {1:.4g}/s'.format(DWT_COUNTER_NAMES[idx], rates[idx])
+            if self.counts[DWT_COUNTER_CYC] and self.increment[DWT_COUNTER_CYC] != 1:
+                # With known cycle counts also give per-cycle ratios:
+                cycles = self.counts[DWT_COUNTER_CYC]
+                for idx in range(DWT_COUNTER_CYC):
+                    if self.counts[idx]:
+                        data_str += ' {0:s}/Cyc {1:.3f}'.format(DWT_COUNTER_NAMES[idx], self.counts[idx] / cycles)
+            if data_str == '':
+                data_str = ' idle'
+            # The running 64-bit totals are given alongside the rates:
+            totals_str = ' '.join('{0:s} {1:d}'.format(name, total) for (name, total) in zip(DWT_COUNTER_NAMES, self.totals))
+            nf = AnalyzerFrame('rate', self.window_start, end_time, {'val': data_str[1:], 'totals': totals_str })
+        self.counts = [0] * len(DWT_COUNTER_NAMES)
+        self.window_start = end_time
+        return nf
 
-        # Cope with stimulas port page extension:
-        paddr = (self.ipage * 32) + self.pcode
+    def wrap_packet(self, pkt):
+        return self.wrap(pkt.start_time, pkt.end_time, pkt.data & 0xFF)
 
-        if self.dstyle is DecodeStyle.Port:
-            if paddr != self.portaddr:
-                return None
+    def wrap(self, start_time, end_time, bits):
+        nf = None
+        if self.window_start is None:
+            self.window_start = start_time
+        elif float(start_time - self.window_start) >= self.window:
+            nf = self.flush(start_time)
+        for idx in range(len(DWT_COUNTER_NAMES)):
+            if bits & (1 << idx):
+                self.counts[idx] += self.increment[idx]
+                self.totals[idx] = ((self.totals[idx] + self.increment[idx]) & 0xFFFFFFFFFFFFFFFF)
+        return nf
 
-        if self.dstyle is DecodeStyle.Console:
-            if paddr != self.portaddr:
-                return None
-            else:
-                # We group all characters between newlines into single reported
-                # frames to make it easier for the user to track whole
-                # messages that have been split across multiple TPIU packets.
-                if self.conctx is None:
-                    self.conctx = ConsoleCtx(frame.start_time)
-                nframes = []
-                for idx in range(self.size):
-                    nf = self.conctx.cdata(frame, ((self.pdata >> (idx * 8)) & 0xFF))
-                    if nf != None:
-                        nframes.append(nf)
-                return nframes
-                # ALTERNATIVE: code if we want individual characters reported:
-                # for idx in range(self.size):
-                #    data_str += '{0:c}'.format((self.pdata >> (idx * 8)) & 0xFF)
-                # do_raw = False
-
-        if self.dstyle is DecodeStyle.Instrumentation:
-            if paddr != self.portaddr:
-                return None
-            else:
-                if self.instrumentation == None:
-                    self.instrumentation = Instrumentation()
-                return self.instrumentation.packet(self.start_time, frame.end_time, self.size, self.pdata)
-
-        self.end_time = frame.end_time
-
-        # Extra DBG
-        #data_str += '(DBG: dstyle {0:d} portaddr {1:d}) '.format(self.dstyle, int(self.portaddr))
-
-        if do_raw:
-            data_str += "Port#{0:d} Size#{1:d}".format(paddr,self.size)
-            data_str += ' '
-            if self.size == 1:
-                data_str += "Data#{0:02X}".format(self.pdata & 0xFF)
-            elif self.size == 2:
-                data_str += "Data#{0:04X}".format(self.pdata & 0xFFFF)
-            else:
-                data_str += "Data#{0:08X}".format(self.pdata & 0xFFFFFFFF)
-        return AnalyzerFrame(do_tag, self.start_time, self.end_time, {'val': data_str })
+#------------------------------------------------------------------------------
+# Packet event formatting as AnalyzerFrames
+
+class PktFrames:
+    def itm(self, pkt):
+        data_str = "Port#{0:d} Size#{1:d}".format(pkt.port, pkt.size)
+        data_str += ' '
+        if pkt.size == 1:
+            data_str += "Data#{0:02X}".format(pkt.data & 0xFF)
+        elif pkt.size == 2:
+            data_str += "Data#{0:04X}".format(pkt.data & 0xFFFF)
+        else:
+            data_str += "Data#{0:08X}".format(pkt.data & 0xFFFFFFFF)
+        return AnalyzerFrame('itm', pkt.start_time, pkt.end_time, {'val': data_str })
 
-    def dwt_process_data(self, frame):
-        self.end_time = frame.end_time
-        if self.dstyle == DecodeStyle.Console:
-            return None
+    def dwt(self, pkt):
         data_str = ''
-        if self.pcode == DWT_ID_PC_SAMPLE:
+        if pkt.kind is PktKind.PC_SAMPLE:
             # The POSTCNT counter period determines the PC sampling interval
             #
             # 1-byte for WFI/WFE (CPU asleep) or 4-byte for PC sample:
-            if self.size == 1:
-                if self.pdata == 0:
+            if pkt.size == 1:
+                if pkt.data == 0:
                     # ARMv7-M D4.3.3 Full periodic PC sample packet
                     data_str += ' IDLE:SLEEP'
                 else:
                     # Reserved
-                    data_str += ' IDLE:{0:02X}'.format(self.pdata & 0xFF)
-            elif self.size == 4:
-                data_str += ' PC:{0:08X}'.format(self.pdata)
+                    data_str += ' IDLE:{0:02X}'.format(pkt.data & 0xFF)
+            elif pkt.size == 4:
+                data_str += ' PC:{0:08X}'.format(pkt.data)
             else:
                 data_str += ' PC:Unrecognised'
-        elif self.pcode == DWT_ID_EXCEPTION:
+        elif pkt.kind is PktKind.EXCEPTION:
             # 2-byte exception number and event descriptor:
             # byte0: ExceptionNumber[7..0]
             # byte1: ExceptionNumber[8] and FN[1..0]
@@ -297,8 +922,8 @@ class PktCtx:
             #  1 entered exception indicated by ExceptionNumber
             #  2 exited exception indicated by ExceptionNumber
             #  3 returned to exception indicated by ExceptionNumber
-            exception_number = (self.pdata & 0x1FF)
-            fn = ((self.pdata >> 12) & 0x3)
+            exception_number = (pkt.data & 0x1FF)
+            fn = ((pkt.data >> 12) & 0x3)
             fn_reason = 'RESERVED'
             if fn == 1:
                 fn_reason = 'ENTERED'
@@ -307,7 +932,7 @@ class PktCtx:
             elif fn == 3:
                 fn_reason = 'RESUMED'
             data_str += ' EXC {0:d} {1:s}'.format(exception_number, fn_reason)
-        elif self.pcode == DWT_ID_EVENT_COUNTER_WRAP:
+        elif pkt.kind is PktKind.WRAP:
             # 1-byte with bitmask of counter overflow marker bits
             #  b7      b6      b5      b4      b3      b2      b1     b0
             # |   0   |   0   |  Cyc  | Fold  |  LSU  | Sleep |  Exc |  CPI  |
@@ -318,9 +943,9 @@ class PktCtx:
             # b2 Sleep  SLEEPCNT profiling counter
             # b1 Exc    EXCCNT   profiling counter
             # b0 CPI    CPICNT   profiling counter
-            data_str += ' WRAP {0:02X}'.format(self.pdata & 0xFF)
+            data_str += ' WRAP {0:02X}'.format(pkt.data & 0xFF)
         else:
-            if self.pcode < 8:
+            if pkt.code < 8:
                 data_str += ' RESERVED'
             else:
                 # Data trace packets 8..23:
@@ -341,73 +966,320 @@ class PktCtx:
                 # Data value packet write: 1-, 2- or 4-bytes
                 data_str += ' DATA-TRACE:IGNORED'
 
-        return AnalyzerFrame('dwt', self.start_time, self.end_time, {'val': data_str })
+        return AnalyzerFrame('dwt', pkt.start_time, pkt.end_time, {'val': data_str })
 
-    def ext_process_data(self, frame):
-        self.end_time = frame.end_time
-        data_str = ' {0:08X}'.format(self.pdata)
-        return AnalyzerFrame('ext', self.start_time, self.end_time, {'val': data_str })
+    def ext(self, pkt):
+        data_str = ' {0:08X}'.format(pkt.data)
+        return AnalyzerFrame('ext', pkt.start_time, pkt.end_time, {'val': data_str })
 
-    def local_timestamp(self, frame):
-        self.end_time = frame.end_time
-        data_str = 'Local TS {0:d}'.format(self.pdata)
-        if self.pcode == 0:
+    def local_timestamp(self, pkt):
+        data_str = 'Local TS {0:d}'.format(pkt.data)
+        if pkt.code == 0:
             data_str += ' synchronous'
-        elif self.pcode == 1:
+        elif pkt.code == 1:
             data_str += ' delayed'
-        elif self.pcode == 2:
+        elif pkt.code == 2:
             data_str += ' delayed-generated'
-        elif self.pcode == 3:
+        elif pkt.code == 3:
             data_str += ' delayed-relative'
         else:
             data_str += ' UNKNOWN'
-        return AnalyzerFrame('console', self.start_time, self.end_time, {'val': data_str })
+        return AnalyzerFrame('console', pkt.start_time, pkt.end_time, {'val': data_str })
 
-    def global_timestamp1(self, frame):
-        self.end_time = frame.end_time
-        data_str = 'Global TS {0:d}'.format(self.pdata)
-        if (self.pcode & (1 << 5)):
+    def global_timestamp1(self, pkt):
+        data_str = 'Global TS {0:d}'.format(pkt.data)
+        if (pkt.code & (1 << 5)):
             data_str += ' ClkChk'
-        if (self.pcode & (1 << 6)):
+        if (pkt.code & (1 << 6)):
             data_str += ' Wrap'
-        return AnalyzerFrame('console', self.start_time, self.end_time, {'val': data_str })
+        return AnalyzerFrame('console', pkt.start_time, pkt.end_time, {'val': data_str })
+
+    def global_timestamp2(self, pkt):
+        data_str = 'Global TS Hi-order {0:d}'.format(pkt.data)
+        return AnalyzerFrame('console', pkt.start_time, pkt.end_time, {'val': data_str })
+
+    def sync(self, pkt):
+        data_str = 'SYNC'
+        return AnalyzerFrame('console', pkt.start_time, pkt.end_time, {'val': data_str })
+
+#------------------------------------------------------------------------------
+
+class PktCtx:
+    def __init__(self, start_time, dstyle, portaddr):
+        self.start_time = start_time
+        self.end_time = 0
+        self.portaddr = portaddr
+        self.fsm = TPIU_FSM.HDR
+        self.ipage = 0
+        self.size = 0
+        self.pcode = 0
+        self.pdata = 0
+        # Payload bytes collected, and the bit position of the next
+        # continuation byte:
+        self.pbuf = bytearray()
+        self.shift = 0
+        # Per-state byte handlers, and the packet completion for each
+        # payload or continuation state:
+        self.states = (self.hdr, self.payload, self.payload, self.cont, self.cont, self.cont, self.cont)
+        self.complete = (None, self.itm_process_data, self.dwt_process_data, self.ext_process_data, self.local_timestamp, self.global_timestamp1, self.global_timestamp2)
+        self.dstyle = dstyle
+        self.instrumentation = {}
+        self.inst_ports = None
+        self.inst_layouts = None
+        self.inst_timer_hz = 0
+        self.window = 0.0
+        self.hold = 0.0
+        self.conctx = None
+        self.search = None
+        self.counters = None
+        self.gts_lo = 0
+        self.gts_hi = 0
+        self.gts_time = None
+        self.gts_pending = None
+        self.syncidx = 0
+        self.header = 0
+        # Packet event subscribers by kind, and for ITM packets by
+        # stimulus port address:
+        self.pkt = PktEvent()
+        self.subscribers = [[] for kind in PktKind]
+        self.port_subscribers = [[] for paddr in range(ITM_PORTS)]
+        self.attached = False
+        # Framing error recovery: header bytes seen in decoded packets,
+        # and the bytes lost since the last error:
+        self.headers = bytearray(256)
+        self.nheaders = 0
+        self.hunting = False
+        self.hunt_reason = None
+        self.hunt_zeros = 0 # run of SYNC (0x00) bytes seen while hunting
+        self.hunt_start = None
+        self.zero_end = None
+        self.lost = 0
+        self.lost_start = None
+        self.lost_end = None
+        self.errors = 0
+
+    def configure(self, window=0.0, hold=0.0, postcnt_period=0, search=None, inst_timer_hz=0):
+        # Decode style specific setup, common to the analyser and the
+        # offline (swo.py) and live (swoservice.py) decoders. Raises
+        # ValueError (or re.error) for missing or bad search patterns.
+        self.window = window
+        self.hold = hold
+        self.inst_timer_hz = inst_timer_hz
+        if self.dstyle is DecodeStyle.Counters:
+            if window == 0:
+                window = 1.0
+            self.counters = DWTCounters(window, postcnt_period)
+        if self.dstyle is DecodeStyle.Search:
+            if not search:
+                raise ValueError('none given for the Search style')
+            self.search = ConsoleSearch(search)
+
+    def flush(self, now):
+        # Output held partial frames older than the hold time
+        frames = []
+        if self.conctx is not None:
+            nf = self.conctx.flush(now, self.hold)
+            if nf != None:
+                frames.append(nf)
+        for inst in self.instrumentation.values():
+            nf = inst.flush(now, self.hold)
+            if nf != None:
+                frames.append(nf)
+        return frames
+
+    def subscribe(self, kinds, handler, ports=None):
+        # Register handler(pkt) for the given packet kinds, optionally
+        # limiting ITM packets to the given stimulus port addresses
+        for kind in kinds:
+            if kind is PktKind.ITM:
+                if ports is None:
+                    ports = range(ITM_PORTS)
+                for paddr in ports:
+                    self.port_subscribers[paddr].append(handler)
+            else:
+                self.subscribers[kind].append(handler)
+
+    def attach(self):
+        # Subscribe the consumers for the decode style. This is done
+        # when the first packet is decoded so that the consumers
+        # configured after construction are included.
+        self.attached = True
+        dstyle = self.dstyle
+        if dstyle is None:
+            # Only the explicitly subscribed consumers
+            return
+        portaddr = int(self.portaddr)
+        frames = PktFrames()
+        if dstyle is DecodeStyle.All:
+            self.subscribe((PktKind.ITM,), frames.itm)
+        elif dstyle is DecodeStyle.Port:
+            self.subscribe((PktKind.ITM,), frames.itm, (portaddr,))
+        elif dstyle is DecodeStyle.Console:
+            # We group all characters between newlines into single reported
+            # frames to make it easier for the user to track whole
+            # messages that have been split across multiple TPIU packets.
+            if self.conctx is None:
+                self.conctx = ConsoleCtx(self.start_time)
+            self.subscribe((PktKind.ITM,), self.conctx.itm_packet, (portaddr,))
+        elif dstyle is DecodeStyle.Search:
+            if self.search is not None:
+                self.subscribe((PktKind.ITM,), self.search.itm_packet, (portaddr,))
+        elif dstyle is DecodeStyle.Instrumentation or dstyle is DecodeStyle.Timeline:
+            ports = set([portaddr])
+            if self.inst_ports:
+                ports |= set(paddr for paddr in self.inst_ports if 0 <= paddr < ITM_PORTS)
+            self.subscribe((PktKind.ITM,), self.inst_packet, sorted(ports))
+        if dstyle is DecodeStyle.All or dstyle is DecodeStyle.Port or dstyle is DecodeStyle.Instrumentation:
+            self.subscribe((PktKind.PC_SAMPLE, PktKind.EXCEPTION, PktKind.WRAP, PktKind.DWT), frames.dwt)
+        if dstyle is DecodeStyle.Counters and self.counters is not None:
+            self.subscribe((PktKind.WRAP,), self.counters.wrap_packet)
+        self.subscribe((PktKind.EXTENSION,), frames.ext)
+        self.subscribe((PktKind.LOCAL_TS,), frames.local_timestamp)
+        self.subscribe((PktKind.GLOBAL_TS1,), frames.global_timestamp1)
+        self.subscribe((PktKind.GLOBAL_TS2,), frames.global_timestamp2)
+        if dstyle is not DecodeStyle.Console and dstyle is not DecodeStyle.Search and dstyle is not DecodeStyle.Counters:
+            self.subscribe((PktKind.SYNC,), frames.sync)
+
+    def inst_packet(self, pkt):
+        # Each instrumentation port has its own record assembler:
+        inst = self.instrumentation.get(pkt.port)
+        if inst == None:
+            inst_port = None
+            if self.inst_ports:
+                inst_port = pkt.port
+            consumer = None
+            if self.dstyle is DecodeStyle.Timeline:
+                consumer = ThreadTimeline(self.window, self.inst_timer_hz)
+            inst = Instrumentation(self.inst_layouts, inst_port, consumer)
+            self.instrumentation[pkt.port] = inst
+        return inst.packet(pkt.start_time, pkt.end_time, pkt.size, pkt.data)
+
+    def dispatch(self, kind, end_time, subs):
+        # Pass the completed packet to its subscribers
+        if not self.attached:
+            self.attach()
+        if not subs:
+            return None
+        pkt = self.pkt
+        pkt.kind = kind
+        pkt.start_time = self.start_time
+        pkt.end_time = end_time
+        pkt.code = self.pcode
+        pkt.size = self.size
+        pkt.data = self.pdata
+        if len(subs) == 1:
+            return subs[0](pkt)
+        frames = []
+        for handler in subs:
+            nf = handler(pkt)
+            if nf != None:
+                if isinstance(nf, list):
+                    frames += nf
+                else:
+                    frames.append(nf)
+        if len(frames) == 0:
+            return None
+        return frames
 
-    def global_timestamp2(self, frame):
-        self.end_time = frame.end_time
-        data_str = 'Global TS Hi-order {0:d}'.format(self.pdata)
-        return AnalyzerFrame('console', self.start_time, self.end_time, {'val': data_str })
+    def itm_process_data(self, start_time, end_time):
+        self.seen(self.header)
+        self.end_time = end_time
+        # Cope with stimulas port page extension:
+        paddr = (self.ipage * 32) + self.pcode
+        self.pkt.port = paddr
+        return self.dispatch(PktKind.ITM, end_time, self.port_subscribers[paddr])
 
-    def hdr(self, frame, db):
+    def dwt_process_data(self, start_time, end_time):
+        self.seen(self.header)
+        self.end_time = end_time
+        if self.pcode == DWT_ID_PC_SAMPLE:
+            kind = PktKind.PC_SAMPLE
+        elif self.pcode == DWT_ID_EXCEPTION:
+            kind = PktKind.EXCEPTION
+        elif self.pcode == DWT_ID_EVENT_COUNTER_WRAP:
+            kind = PktKind.WRAP
+        else:
+            kind = PktKind.DWT
+        return self.dispatch(kind, end_time, self.subscribers[kind])
+
+    def ext_process_data(self, start_time, end_time):
+        self.seen(self.header)
+        self.end_time = end_time
+        return self.dispatch(PktKind.EXTENSION, end_time, self.subscribers[PktKind.EXTENSION])
+
+    def local_timestamp(self, start_time, end_time):
+        self.seen(self.header)
+        self.end_time = end_time
+        return self.dispatch(PktKind.LOCAL_TS, end_time, self.subscribers[PktKind.LOCAL_TS])
+
+    def global_timestamp1(self, start_time, end_time):
+        self.seen(self.header)
+        self.end_time = end_time
+        # Track the reconstructed global time (and the capture time it
+        # was seen at) for use as a common timebase. A GTS1 packet only
+        # carries the low-order bits that have changed since the last
+        # one, 7-bits per byte:
+        mask = ((1 << min(self.shift + 7, 26)) - 1)
+        gts_lo = ((self.gts_lo & ~mask) | (self.pdata & mask))
+        if (self.pcode & 0x60):
+            # Wrap (or a ClkCh full timestamp) : the high-order bits have
+            # changed, so the timebase is only updated once the following
+            # GTS2 packet provides them
+            self.gts_pending = (gts_lo, self.start_time)
+        else:
+            self.gts_lo = gts_lo
+            self.gts_time = self.start_time
+            self.gts_pending = None
+        return self.dispatch(PktKind.GLOBAL_TS1, end_time, self.subscribers[PktKind.GLOBAL_TS1])
+
+    def global_timestamp2(self, start_time, end_time):
+        self.seen(self.header)
+        self.end_time = end_time
+        if self.gts_pending is not None:
+            (self.gts_lo, self.gts_time) = self.gts_pending
+            self.gts_hi = self.pdata
+            self.gts_pending = None
+        return self.dispatch(PktKind.GLOBAL_TS2, end_time, self.subscribers[PktKind.GLOBAL_TS2])
+
+    def global_time(self):
+        # The reconstructed global timestamp, or None before the first
+        # GTS packets have been decoded
+        if self.gts_time is None:
+            return None
+        return ((self.gts_hi << 26) | self.gts_lo)
+
+    def hdr(self, db, start_time, end_time):
         decoded = None
 
         if self.syncidx:
             self.syncidx += 1
             if self.syncidx == 6:
-                if db == ITMDWTPP_SYNCEND:
-                    if self.dstyle != DecodeStyle.Console:
-                        data_str = 'SYNC'
-                        decoded = AnalyzerFrame('console', self.start_time, frame.end_time, {'val': data_str })
+                if db == ITMDWTPP_SYNC:
+                    # A SYNC is at least 47 zero bits, so may be longer
+                    self.syncidx = 5
+                elif db == ITMDWTPP_SYNCEND:
+                    decoded = self.dispatch(PktKind.SYNC, end_time, self.subscribers[PktKind.SYNC])
+                    self.syncidx = 0
                 else:
-                    data_str = 'BadSync: Expected {0:02X} saw {1:02X}'.format(ITMDWTPP_SYNCEND, db)
-                    decoded = AnalyzerFrame('err', self.start_time, frame.end_time, {'val': data_str })
-                self.syncidx = 0
+                    decoded = self.bad_sync(ITMDWTPP_SYNCEND, db, start_time, end_time)
             else:
                 if db != ITMDWTPP_SYNC:
-                    data_str = 'BadSync: Expected {0:02X} saw {1:02X}'.format(ITMDWTPP_SYNC, db)
-                    decoded = AnalyzerFrame('err', self.start_time, frame.end_time, {'val': data_str })
-                    self.syncidx = 0
+                    decoded = self.bad_sync(ITMDWTPP_SYNC, db, start_time, end_time)
         elif (db == ITMDWTPP_SYNC):
             # ignore and stay at HDR
-            self.start_time = frame.start_time
+            self.start_time = start_time
             self.ipage = 0
             self.syncidx = 1
         elif (db == ITMDWTPP_OVERFLOW):
-            # ignore and stay at HDR
+            # stay at HDR
             # CONSIDER: output saleae frame showing 1-byte OVERFLOW
+            self.start_time = start_time
+            decoded = self.dispatch(PktKind.OVERFLOW, end_time, self.subscribers[PktKind.OVERFLOW])
             self.start_time = None
         else:
             if self.start_time == None:
-                self.start_time = frame.start_time
+                self.start_time = start_time
+            self.header = db
             source = (db & ITMDWTPP_TYPE_MASK)
             size = 0
 
@@ -422,6 +1294,7 @@ class PktCtx:
                         # (C)ontinuation
                         self.fsm = TPIU_FSM.EXT
                         self.pdata = ((db >> 4) & 0x7)
+                        self.shift = 3
                         # We track byte number in self.size
                     else:
                         # Single byte: check SH:
@@ -438,6 +1311,7 @@ class PktCtx:
                     if db & ITMDWTPP_SOURCE_SELECTION:
                         self.pdata = 0
                         self.pcode = 0
+                        self.shift = 0
                         if (db == 0x94):
                             # GTS1 header is 0x94
                             self.fsm = TPIU_FSM.GTS1
@@ -448,8 +1322,8 @@ class PktCtx:
                             data_str = 'Global TimeStamp Decode {0:02X}'.format(db)
                             use_start = self.start_time
                             if use_start == None:
-                                use_start = frame.start_time
-                            decoded = AnalyzerFrame('err', use_start, frame.end_time, {'val': data_str })
+                                use_start = start_time
+                            decoded = AnalyzerFrame('err', use_start, end_time, {'val': data_str })
                     else:
                         # TimeStamp 1..5-bytes
                         # 0bCDDD000
@@ -473,11 +1347,12 @@ class PktCtx:
                             self.fsm = TPIU_FSM.LTS
                             self.pcode = ((db >> 4) & 0x7) # Timestamp Control
                             self.pdata = 0
+                            self.shift = 0
                         else:
                             # Single byte local timestamp
                             self.pcode = 0 # timestamp emitted synchronous to ITM data
                             self.pdata = ((db >> 4) & 0x7) # will be TimeStamp value of 1..6
-                            decoded = self.local_timestamp(frame)
+                            decoded = self.local_timestamp(start_time, end_time)
                             # Stay at HDR
             else: # SWIT : Software Source
                 if source == ITMDWTPP_TYPE_SOURCE1:
@@ -496,188 +1371,197 @@ class PktCtx:
                     # (C)ontinuation flag, and the bottom (least
                     # significant) bit should always be zero. Of
                     # the 5-bits of id only 3 encode the feature.
-                    self.fsm = TPIU_FSM.DWT1
+                    self.fsm = TPIU_FSM.DWT
                     self.pcode = id
-                    self.pdata = 0
                 else:
                     port = ((db & ITMDWTPP_SOURCE_MASK) >> ITMDWTPP_SOURCE_SHIFT)
-                    self.fsm = TPIU_FSM.ITM1
+                    self.fsm = TPIU_FSM.ITM
                     self.pcode = port;
-                    self.pdata = 0;
-                self.start_time = frame.start_time
+                self.start_time = start_time
             self.size = size
         return decoded
 
-    def itm1(self, frame, db):
-        decoded = None
-        self.pdata = db
-        if self.size == 1:
-            decoded = self.itm_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-        else:
-            self.fsm = TPIU_FSM.ITM2
-        return decoded
-
-    def itm2(self, frame, db):
-        decoded = None
-        self.pdata |= (db << 8)
-        if self.size == 2:
-            decoded = self.itm_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-        else:
-            self.fsm = TPIU_FSM.ITM3
-        return decoded
-
-    def itm3(self, frame, db):
-        decoded = None
-        self.pdata |= (db << 16)
-        if self.size == 3:
-            decoded = self.itm_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-        else:
-            self.fsm = TPIU_FSM.ITM4
-        return decoded
-
-    def itm4(self, frame, db):
-        decoded = None
-        self.pdata |= (db << 24)
-        if self.size == 4:
-            decoded = self.itm_process_data(frame)
-        self.fsm = TPIU_FSM.HDR
-        return decoded
-
-    def dwt1(self, frame, db):
-        decoded = None
-        self.pdata = db
-        if self.size == 1:
-            decoded = self.dwt_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-        else:
-            self.fsm = TPIU_FSM.DWT2
-        return decoded
-
-    def dwt2(self, frame, db):
-        decoded = None
-        self.pdata |= (db << 8)
-        if self.size == 2:
-            decoded = self.dwt_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-        else:
-            self.fsm = TPIU_FSM.DWT3
-        return decoded
-
-    def dwt3(self, frame, db):
-        decoded = None
-        self.pdata |= (db << 16)
-        if self.size == 3:
-            decoded = self.dwt_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-        else:
-            self.fsm = TPIU_FSM.DWT4
-        return decoded
-
-    def dwt4(self, frame, db):
-        decoded = None
-        self.pdata |= (db << 24)
-        if self.size == 4:
-            decoded = self.dwt_process_data(frame)
+    def payload(self, db, start_time, end_time):
+        # Collect the fixed size ITM or DWT payload
+        pbuf = self.pbuf
+        pbuf.append(db)
+        if len(pbuf) < self.size:
+            return None
+        self.pdata = int.from_bytes(pbuf, 'little')
+        pbuf.clear()
+        fsm = self.fsm
         self.fsm = TPIU_FSM.HDR
-        return decoded
-
-    def ext(self, frame, db):
-        decoded = None
-        continuation = False
-        if self.size == 0:
-            self.pdata |= ((db & 0x7F) << 3)
-            continuation = (db & (1 << 7))
-        elif self.size == 1:
-            self.pdata |= ((db & 0x7F) << 10)
-            continuation = (db & (1 << 7))
-        elif self.size == 2:
-            self.pdata |= ((db & 0x7F) << 17)
-            continuation = (db & (1 << 7))
-        else: # size == 3
-            self.pdata |= (db << 24)
-            continuation = False
-
-        if continuation:
-            self.size += 1
-        else:
-            decoded = self.ext_process_data(frame)
-            self.fsm = TPIU_FSM.HDR
-
-        return decoded
-
-    def lts(self, frame, db):
-        decoded = None
-        self.pdata |= ((db & 0x7F) << (self.size * 7))
+        return self.complete[fsm](start_time, end_time)
+
+    def cont(self, db, start_time, end_time):
+        # Accumulate 7-bits per byte of a variable length (EXT, LTS and
+        # GTS) packet until a byte without the (C)ontinuation bit
+        if self.size == CONT_LAST[self.fsm]:
+            return self.cont_end(db, start_time, end_time)
+        self.pdata |= ((db & 0x7F) << self.shift)
         if (db & (1 << 7)):
+            self.shift += 7
             self.size += 1
-            if (self.size == 4):
-                data_str = 'Local TimeStamp Continuation'
-                decoded = AnalyzerFrame('err', self.start_time, frame.end_time, {'val': data_str })
-                self.fsm = TPIU_FSM.HDR
-        else:
-            decoded = self.local_timestamp(frame)
-            self.fsm = TPIU_FSM.HDR
-
-        return decoded
-
-    def gts1(self, frame, db):
-        decoded = None
+            return None
+        fsm = self.fsm
+        self.fsm = TPIU_FSM.HDR
+        return self.complete[fsm](start_time, end_time)
 
-        if (self.size != 3):
-            self.pdata |= ((db & 0x7F) << (self.size * 7))
-        else: # bits 21..25
-            self.pdata |= ((db & 0x1F) << (self.size * 7))
-            self.pcode = (db & 0x60) # Wrap and ClkCh flags
+    def cont_end(self, db, start_time, end_time):
+        # Last possible byte of a continuation packet
+        fsm = self.fsm
+        self.fsm = TPIU_FSM.HDR
+        if fsm == TPIU_FSM.EXT:
+            # Bits 24..31 with no continuation bit
+            self.pdata |= (db << self.shift)
+            return self.ext_process_data(start_time, end_time)
+        if fsm == TPIU_FSM.GTS1:
+            # Bits 21..25 with the Wrap and ClkCh flags
+            self.pdata |= ((db & 0x1F) << self.shift)
+            self.pcode = (db & 0x60)
+        else:
+            # GTS2 may be 5-byte (bits 26..47) or 7-byte (bits 26..63)
+            self.pdata |= ((db & 0x7F) << self.shift)
         if (db & (1 << 7)):
             self.size += 1
-            if (self.size == 4):
-                data_str = 'Global TimeStamp1 Continuation'
-                decoded = AnalyzerFrame('err', self.start_time, frame.end_time, {'val': data_str })
-                self.fsm = TPIU_FSM.HDR
-        else:
-            decoded = self.global_timestamp1(frame)
-            self.fsm = TPIU_FSM.HDR
+            data_str = CONT_ERRORS[fsm]
+            return AnalyzerFrame('err', self.start_time, end_time, {'val': data_str })
+        return self.complete[fsm](start_time, end_time)
+
+    def seen(self, db):
+        # Record a header byte that started a successfully decoded packet
+        if not self.headers[db]:
+            self.headers[db] = 1
+            self.nheaders += 1
+
+    def error_byte(self, start_time, end_time, count=1, reason='Framing error'):
+        # A byte with a serial framing error (or count bytes missing
+        # from the stream): drop it along with any partially decoded
+        # packet, and hunt for the next packet header.
+        lost = count
+        if self.syncidx:
+            lost += self.syncidx
+        elif self.fsm == TPIU_FSM.ITM or self.fsm == TPIU_FSM.DWT:
+            lost += (1 + len(self.pbuf))
+            self.pbuf.clear()
+        elif self.fsm != TPIU_FSM.HDR:
+            lost += (1 + self.size)
+        if self.hunt_zeros:
+            # A partial SYNC run is lost too:
+            lost += self.hunt_zeros
+            self.hunt_zeros = 0
+            if self.lost_start is None:
+                self.lost_start = self.hunt_start
+        if not self.hunting:
+            self.hunting = True
+            self.lost_start = start_time
+            if self.fsm != TPIU_FSM.HDR or self.syncidx:
+                if self.start_time is not None:
+                    self.lost_start = self.start_time
+        elif self.lost_start is None:
+            self.lost_start = start_time
+        self.hunt_reason = reason
+        self.lost += lost
+        self.lost_end = end_time
+        self.errors += 1
+        self.fsm = TPIU_FSM.HDR
+        self.syncidx = 0
+        self.start_time = None
+        return None
 
-        return decoded
+    def plausible(self, db):
+        # Header plausibility while hunting after an error. We accept a
+        # header byte that has already started a good packet in this
+        # capture; a link normally carries a small set of (port, size)
+        # headers so a random payload byte is unlikely to match. Until
+        # any packets have been decoded we accept any SWIT/HW source
+        # header. SYNC is handled by hunt() since a single 0x00 is a
+        # common payload byte.
+        if self.nheaders:
+            return (self.headers[db] != 0)
+        return ((db & ITMDWTPP_TYPE_MASK) != ITMDWTPP_TYPE_PROTOCOL)
+
+    def bad_sync(self, expected, db, start_time, end_time):
+        # The 0x00 byte(s) taken as the start of a SYNC were not, so we
+        # have lost packet alignment : report the bad SYNC and hunt for
+        # the next packet (from the byte that broke the SYNC, which may
+        # itself be a header)
+        data_str = 'BadSync: Expected {0:02X} saw {1:02X}'.format(expected, db)
+        nf = AnalyzerFrame('err', self.start_time, end_time, {'val': data_str })
+        self.syncidx = 0
+        self.start_time = None
+        self.hunting = True
+        self.hunt_reason = 'BadSync'
+        self.lost_start = None
+        decoded = self.hunt(db, start_time, end_time)
+        if decoded is None:
+            return nf
+        if isinstance(decoded, list):
+            return [nf] + decoded
+        return [nf, decoded]
+
+    def lose(self, start_time, end_time, count=1):
+        if self.lost_start is None:
+            self.lost_start = start_time
+        self.lost += count
+        self.lost_end = end_time
+
+    def resynced(self):
+        # Stop hunting : returns the error frame reporting the bytes
+        # lost (if any)
+        self.hunting = False
+        lost = self.lost
+        self.lost = 0
+        if lost == 0:
+            return None
+        data_str = '{0:s}: lost {1:d} byte{2:s}'.format(self.hunt_reason, lost, '' if lost == 1 else 's')
+        nf = AnalyzerFrame('err', self.lost_start, self.lost_end, {'val': data_str, 'lost': lost })
+        self.lost_start = None
+        return nf
 
-    def gts2(self, frame, db):
-        # Hi-order bits for most recently transmitted GTS1 packet
-        decoded = None
-        self.pdata |= ((db & 0x7F) << (self.size * 7))
-        if (db & (1 << 7)):
-            self.size += 1
-            # may be 5-byte (bits 26..47) or 7-byte (bits 26..63) packet
-            if (self.size == 6):
-                data_str = 'Global TimeStamp2 Continuation'
-                decoded = AnalyzerFrame('err', self.start_time, frame.end_time, {'val': data_str })
-                self.fsm = TPIU_FSM.HDR
+    def hunt(self, db, start_time, end_time):
+        # Returns None while still hunting, otherwise the frame
+        # reporting the bytes lost along with the output for the packet
+        # that restarted decoding. Only a complete SYNC (at least five
+        # 0x00 bytes and then 0x80) or a plausible header is accepted.
+        if db == ITMDWTPP_SYNC:
+            if self.hunt_zeros == 0:
+                self.hunt_start = start_time
+            self.hunt_zeros += 1
+            self.zero_end = end_time
+            return None
+        zeros = self.hunt_zeros
+        self.hunt_zeros = 0
+        if db == ITMDWTPP_SYNCEND and zeros >= 5:
+            nf = self.resynced()
+            self.start_time = self.hunt_start
+            decoded = self.dispatch(PktKind.SYNC, end_time, self.subscribers[PktKind.SYNC])
+            self.start_time = None
         else:
-            decoded = self.global_timestamp2(frame)
-            self.fsm = TPIU_FSM.HDR
-
-        return decoded
+            if zeros:
+                self.lose(self.hunt_start, self.zero_end, zeros)
+            if not self.plausible(db):
+                self.lose(start_time, end_time)
+                return None
+            nf = self.resynced()
+            decoded = self.states[self.fsm](db, start_time, end_time)
+        if decoded is None:
+            return nf
+        if nf is None:
+            return decoded
+        if isinstance(decoded, list):
+            return [nf] + decoded
+        return [nf, decoded]
 
     def run(self, frame):
-        switcher = {
-            TPIU_FSM.HDR: self.hdr,
-            TPIU_FSM.ITM1: self.itm1,
-            TPIU_FSM.ITM2: self.itm2,
-            TPIU_FSM.ITM3: self.itm3,
-            TPIU_FSM.ITM4: self.itm4,
-            TPIU_FSM.DWT1: self.dwt1,
-            TPIU_FSM.DWT2: self.dwt2,
-            TPIU_FSM.DWT3: self.dwt3,
-            TPIU_FSM.DWT4: self.dwt4,
-            TPIU_FSM.EXT: self.ext,
-            TPIU_FSM.LTS: self.lts,
-            TPIU_FSM.GTS1: self.gts1,
-            TPIU_FSM.GTS2: self.gts2
-        }
-        func = switcher.get(self.fsm)
-        return func(frame, frame.data['data'][0])
+        if frame.data.get('error'):
+            return self.error_byte(frame.start_time, frame.end_time)
+        return self.run_byte(frame.data['data'][0], frame.start_time, frame.end_time)
+
+    def run_byte(self, db, start_time, end_time):
+        if self.hunting:
+            return self.hunt(db, start_time, end_time)
+        return self.states[self.fsm](db, start_time, end_time)
 
 #------------------------------------------------------------------------------
 # ARM TPIU exports 16-byte frames:
@@ -699,13 +1583,26 @@ class PktCtx:
 # TPIU packet.
 
 class TPIUCtx:
-    def __init__(self, tpdstyle, stream_match, offset):
+    def __init__(self, tpdstyle, stream_match, offset, sink=None):
         self.start_time = None
         self.dstyle = tpdstyle
         self.stream_match = stream_match
         self.stream_active = 0
         self.bidx = int(offset)
         self.packet = []
+        # Completed frames, and those carrying only idle fill:
+        self.frames = 0
+        self.idle_frames = 0
+        self.frame_data = False
+        # Framing errors: slots of bad bytes in the current frame, and
+        # the number of stream data bytes invalidated:
+        self.badmask = 0
+        self.bad_bytes = 0
+        # Optional byte-level decoder (providing run_byte() and
+        # error_byte()) for the matched stream in Saleae mode, and the
+        # frames it has decoded (collected by the caller):
+        self.sink = sink
+        self.decoded = []
         # Create dummy bytes for missing data:
         if self.bidx:
             for idx in range(self.bidx):
@@ -717,17 +1614,39 @@ class TPIUCtx:
                 return None
 
         if len(databytes) != 0:
+            if streamid != 0:
+                self.frame_data = True
             if self.dstyle is DecodeStyleTPIU.Saleae:
                 if streamid != self.stream_match:
                     return None
-                # We return Analyzer frames for each byte to be decoded by our higher layer:
+                sink = self.sink
+                if sink is not None:
+                    # Hand the bytes straight to the stream decoder:
+                    decoded = self.decoded
+                    for (raw_byte, byte_start, byte_end) in databytes:
+                        if byte_start is None:
+                            continue
+                        if raw_byte is None:
+                            nf = sink.error_byte(byte_start, byte_end)
+                        else:
+                            nf = sink.run_byte(raw_byte, byte_start, byte_end)
+                        if nf != None:
+                            if isinstance(nf, list):
+                                decoded += nf
+                            else:
+                                decoded.append(nf)
+                    return None
+                # Otherwise we return Analyzer frames for each byte to be decoded by our higher layer:
                 frames = []
                 for idx in range(len(databytes)):
                     raw_byte = databytes[idx][0]
                     byte_start = databytes[idx][1]
                     byte_end = databytes[idx][2]
                     if (byte_start != None) and (byte_end != None):
-                        nf = AnalyzerFrame('data', byte_start, byte_end, { 'data': bytes( [raw_byte] ) } )
+                        if raw_byte is None:
+                            nf = AnalyzerFrame('data', byte_start, byte_end, { 'data': bytes( [0x00] ), 'error': 'TPIU' } )
+                        else:
+                            nf = AnalyzerFrame('data', byte_start, byte_end, { 'data': bytes( [raw_byte] ) } )
                         frames.append(nf)
                 return frames
 
@@ -737,30 +1656,80 @@ class TPIUCtx:
                 byte_start = databytes[idx][1]
                 byte_end = databytes[idx][2]
                 if (byte_start != None) and (byte_end != None):
-                    data_str += ' {0:02X}'.format(raw_byte)
+                    if raw_byte is None:
+                        data_str += ' ??'
+                    else:
+                        data_str += ' {0:02X}'.format(raw_byte)
             return AnalyzerFrame('tpiu', start_time, end_time, {'val': data_str })
 
         return None
 
-    def process_byte(self, frame, db):
+    def skip(self, nbytes, start_time, end_time):
+        # Bytes missing from the stream (e.g. dropped by a receiver that
+        # could not keep up): the partial frame is abandoned, and we
+        # stay aligned with the 16-byte frames by treating the start of
+        # the frame following the gap as dummy fill. The stream ID is
+        # not known until the next ID byte. Returns any frames from the
+        # stream decoder, which drops its partial packet.
+        self.bidx = ((self.bidx + nbytes) % 16)
+        self.packet = [(0x00, None, None)] * self.bidx
+        self.badmask = 0
+        self.start_time = end_time
+        self.stream_active = 0
+        self.frame_data = False
+        if self.sink is None:
+            return []
+        nf = self.sink.error_byte(start_time, end_time, 0, 'Overrun')
+        if nf is None:
+            return []
+        if isinstance(nf, list):
+            return nf
+        return [nf]
+
+    def process_frame(self, packet):
+        # Equivalent to process_byte() for each of a complete frame of
+        # good (db, start_time, end_time) bytes when at a frame boundary,
+        # saving the per-byte overhead for bulk decoding
+        (db, start_time, end_time) = packet.pop()
+        self.start_time = packet[0][1]
+        self.packet = packet
+        self.badmask = 0
+        self.bidx = 15
+        return self.process_byte(db, start_time, end_time)
+
+    def process_byte(self, db, start_time, end_time, error=False):
+        # A byte with a framing error still occupies its slot, so that
+        # we stay aligned with the 16-byte frames, but the stream data
+        # it carries (or qualifies, for byte15) is passed on as bad.
         frames = []
 
         if self.bidx == 0:
-            self.start_time = frame.start_time
+            self.start_time = start_time
             self.packet.clear()
+            self.badmask = 0
+
+        if error:
+            self.badmask |= (1 << self.bidx)
 
         # We need to record the start_time for each data byte supplied
         # so that we can resync into packets by the higher level
         # decoder:
-        self.packet.append( (db, frame.start_time, frame.end_time) )
+        self.packet.append( (db, start_time, end_time) )
 
         self.bidx += 1
         if self.bidx == 16:
+            self.frames += 1
+            self.frame_data = False
             # Process data bytes:
             databytes = []
             lsbits = self.packet[15][0]
+            badmask = self.badmask
+            # A bad byte15 leaves every even data byte without its LSB:
+            lsbad = ((badmask >> 15) & 1)
 
             stream_start_time = self.start_time
+            frame_start_time = self.start_time
+            bad_bytes = self.bad_bytes
             pending_nextstream = None
             do_sync = False
 
@@ -779,9 +1748,10 @@ class TPIUCtx:
                             synclen = (idx + 1)
                             sync_end_time = self.packet[idx][2]
                             if sync_end_time == None:
-                                sync_end_time = frame.end_time
+                                sync_end_time = end_time
                             for si in range(synclen):
                                 del self.packet[0]
+                            self.badmask = (self.badmask >> synclen)
                             self.bidx = (16 - synclen)
                             self.start_time = self.packet[0][1]
                             data_str = 'BAD '
@@ -795,12 +1765,15 @@ class TPIUCtx:
                             break
                         elif pb != 0xFF:
                             data_str = "Expected FF"
-                            nf = AnalyzerFrame('err', stream_start_time, frame.end_time, {'val': data_str })
+                            nf = AnalyzerFrame('err', stream_start_time, end_time, {'val': data_str })
                             frames.append(nf)
                     else:
+                        if (badmask >> idx) & 1:
+                            pb = None
+                            self.bad_bytes += 1
                         databytes.append( (pb, bstart, bend) )
                         if pending_nextstream != None:
-                            nf = self.dump_stream(stream_start_time, frame.end_time, self.stream_active, databytes)
+                            nf = self.dump_stream(stream_start_time, end_time, self.stream_active, databytes)
                             if nf != None:
                                 if isinstance(nf, list):
                                     frames += nf
@@ -811,7 +1784,12 @@ class TPIUCtx:
                             databytes.clear()
                 else:
                     #even
-                    if pb & 1:
+                    if (badmask >> idx) & 1:
+                        # Unknown whether an ID or data; assume data so
+                        # the stream is unchanged:
+                        databytes.append( (None, bstart, bend) )
+                        self.bad_bytes += 1
+                    elif pb & 1:
                         # ARM DDI 0314H 8.12.1
                         # The byte15 flag byte indicates whether the next odd
                         # byte is for the previous stream or the new stream
@@ -836,7 +1814,7 @@ class TPIUCtx:
                                     pending_nextstream = nextstream
                                 else:
                                     # Common with above:
-                                    nf = self.dump_stream(stream_start_time, frame.end_time, self.stream_active, databytes)
+                                    nf = self.dump_stream(stream_start_time, end_time, self.stream_active, databytes)
                                     if nf != None:
                                         if isinstance(nf, list):
                                             frames += nf
@@ -846,20 +1824,456 @@ class TPIUCtx:
                     else:
                         if do_sync:
                             data_str = "Expected LongSync FF"
-                            nf = AnalyzerFrame('err', stream_start_time, frame.end_time, {'val': data_str })
+                            nf = AnalyzerFrame('err', stream_start_time, end_time, {'val': data_str })
                             frames.append(nf)
+                        elif lsbad:
+                            databytes.append( (None, bstart, bend) )
+                            self.bad_bytes += 1
                         else:
                             fb = (pb | ((lsbits >> (idx >> 1)) & 1))
                             databytes.append( (fb, bstart, bend) )
 
             if len(databytes):
-                nf = self.dump_stream(stream_start_time, frame.end_time, self.stream_active, databytes)
+                nf = self.dump_stream(stream_start_time, end_time, self.stream_active, databytes)
                 if nf != None:
                     if isinstance(nf, list):
                         frames += nf
                     else:
                         frames.append(nf)
 
+            if self.bad_bytes != bad_bytes:
+                data_str = 'Framing error: {0:d} bytes invalid (total {1:d})'.format(self.bad_bytes - bad_bytes, self.bad_bytes)
+                frames.append(AnalyzerFrame('err', frame_start_time, end_time, {'val': data_str }))
+
+            if not self.frame_data:
+                self.idle_frames += 1
+
+        return frames
+
+#------------------------------------------------------------------------------
+# ETMv3 instruction trace decoding (as used by the Cortex-M ETM-M3/M4)
+#
+# See ARM IHI 0014 (ETM Architecture Specification) for the packet
+# encoding. The ETM stream is normally routed through the TPIU formatter
+# on its own trace source ID. We assume the "alternative" branch address
+# encoding and Thumb instruction state, which are the only options on
+# Cortex-M parts.
+#
+# CONSIDER: PFTv1 and ETMv4 use different atom/address packet encodings
+# and would need their own header tables.
+
+class ETMPkt(IntEnum):
+    RESERVED = 0
+    ASYNC = 1
+    ISYNC = 2
+    ISYNC_CC = 3
+    BRANCH = 4
+    PHDR1 = 5
+    PHDR2 = 6
+    CYCLE = 7
+    TRIGGER = 8
+    CTXID = 9
+    VMID = 10
+    TIMESTAMP = 11
+    IGNORE = 12
+    EXC_EXIT = 13
+    EXC_ENTRY = 14
+
+ETMPKT_NAMES = {
+    ETMPkt.RESERVED: 'RESERVED',
+    ETMPkt.ASYNC: 'A-SYNC',
+    ETMPkt.ISYNC: 'I-SYNC',
+    ETMPkt.ISYNC_CC: 'I-SYNC',
+    ETMPkt.BRANCH: 'BRANCH',
+    ETMPkt.PHDR1: 'P-HDR',
+    ETMPkt.PHDR2: 'P-HDR',
+    ETMPkt.CYCLE: 'CYCLE',
+    ETMPkt.TRIGGER: 'TRIGGER',
+    ETMPkt.CTXID: 'CONTEXTID',
+    ETMPkt.VMID: 'VMID',
+    ETMPkt.TIMESTAMP: 'TIMESTAMP',
+    ETMPkt.IGNORE: 'IGNORE',
+    ETMPkt.EXC_EXIT: 'EXC-EXIT',
+    ETMPkt.EXC_ENTRY: 'EXC-ENTRY'
+}
+
+def etm_header_table():
+    table = [ETMPkt.RESERVED] * 256
+    for db in range(256):
+        if db & 1:
+            table[db] = ETMPkt.BRANCH # Cxxxxxx1
+        elif (db & 0x83) == 0x80:
+            table[db] = ETMPkt.PHDR1 # 1NEEEE00
+        elif (db & 0xF3) == 0x82:
+            table[db] = ETMPkt.PHDR2 # 1000FF10
+    table[0x00] = ETMPkt.ASYNC
+    table[0x04] = ETMPkt.CYCLE
+    table[0x08] = ETMPkt.ISYNC
+    table[0x0C] = ETMPkt.TRIGGER
+    table[0x3C] = ETMPkt.VMID
+    table[0x42] = ETMPkt.TIMESTAMP
+    table[0x46] = ETMPkt.TIMESTAMP
+    table[0x66] = ETMPkt.IGNORE
+    table[0x6E] = ETMPkt.CTXID
+    table[0x70] = ETMPkt.ISYNC_CC
+    table[0x76] = ETMPkt.EXC_EXIT
+    table[0x7E] = ETMPkt.EXC_ENTRY
+    return table
+
+ETM_HEADERS = etm_header_table()
+
+# Number of address bits carried by each branch address packet byte:
+ETM_BRANCH_BITS = (6, 7, 7, 7, 4)
+
+#------------------------------------------------------------------------------
+# Thumb instruction classification for execution reconstruction. We only
+# need the instruction size and whether it can change the flow of
+# execution (with the target for direct branches). Decoded instructions
+# are cached by address, building up an index of the executed image.
+
+THUMB_NORMAL = 0
+THUMB_DIRECT = 1 # direct branch : target known from the image
+THUMB_INDIRECT = 2 # indirect branch : target from a branch address packet
+
+def thumb_sext(value, bits):
+    if value & (1 << (bits - 1)):
+        value -= (1 << bits)
+    return value
+
+class ThumbIndex:
+    def __init__(self, elf):
+        # Executable (SHF_ALLOC|SHF_EXECINSTR) sections as (addr, size, offset):
+        # Sections extending beyond the file are clipped, so a corrupt
+        # ELF cannot cause reads outside the image:
+        self.regions = []
+        for sh in elf.sections:
+            if (sh[2] & 0x6) == 0x6 and sh[1] != 8:
+                size = min(sh[5], max(len(elf.image) - sh[4], 0))
+                if size:
+                    self.regions.append( (sh[3], size, sh[4]) )
+        self.image = elf.image
+        self.endian = elf.endian
+        self.cache = {}
+
+    def halfword(self, addr):
+        for (base, size, offset) in self.regions:
+            if base <= addr < (base + size - 1):
+                (hw,) = struct.unpack_from(self.endian + 'H', self.image, offset + (addr - base))
+                return hw
+        return None
+
+    def decode(self, addr):
+        # Returns (size, kind, target) or None if not in the image
+        ins = self.cache.get(addr)
+        if ins is not None:
+            return ins
+        hw1 = self.halfword(addr)
+        if hw1 is None:
+            return None
+        kind = THUMB_NORMAL
+        target = None
+        if (hw1 >> 11) in (0x1D, 0x1E, 0x1F):
+            hw2 = self.halfword(addr + 2)
+            if hw2 is None:
+                return None
+            size = 4
+            if (hw1 & 0xF800) == 0xF000 and (hw2 & 0x8000):
+                s = ((hw1 >> 10) & 1)
+                j1 = ((hw2 >> 13) & 1)
+                j2 = ((hw2 >> 11) & 1)
+                if (hw2 & 0x5000) == 0x0000:
+                    # B<c>.W (T3) : unless cond encodes other instructions
+                    if ((hw1 >> 7) & 0x7) != 0x7:
+                        imm = (s << 20) | (j2 << 19) | (j1 << 18) | ((hw1 & 0x3F) << 12) | ((hw2 & 0x7FF) << 1)
+                        kind = THUMB_DIRECT
+                        target = (addr + 4 + thumb_sext(imm, 21)) & 0xFFFFFFFF
+                elif (hw2 & 0x1000):
+                    # B.W (T4) or BL
+                    i1 = (1 ^ (j1 ^ s))
+                    i2 = (1 ^ (j2 ^ s))
+                    imm = (s << 24) | (i1 << 23) | (i2 << 22) | ((hw1 & 0x3FF) << 12) | ((hw2 & 0x7FF) << 1)
+                    kind = THUMB_DIRECT
+                    target = (addr + 4 + thumb_sext(imm, 25)) & 0xFFFFFFFF
+            elif (hw1 & 0xFFF0) == 0xF8D0 and (hw2 >> 12) == 0xF:
+                kind = THUMB_INDIRECT # LDR.W pc, [Rn, #imm]
+            elif (hw1 & 0xFFF0) == 0xF850 and (hw2 >> 12) == 0xF:
+                kind = THUMB_INDIRECT # LDR pc, [Rn, ...]
+            elif ((hw1 & 0xFFD0) == 0xE890 or (hw1 & 0xFFD0) == 0xE910) and (hw2 & 0x8000):
+                kind = THUMB_INDIRECT # LDM/POP.W including pc
+            elif (hw1 & 0xFFF0) == 0xE8D0 and (hw2 & 0xFFE0) == 0xF000:
+                kind = THUMB_INDIRECT # TBB/TBH
+        else:
+            size = 2
+            if (hw1 & 0xF000) == 0xD000 and ((hw1 >> 9) & 0x7) != 0x7:
+                # B<c> (T1) : cond 1110 and 1111 are UDF/SVC
+                kind = THUMB_DIRECT
+                target = (addr + 4 + thumb_sext((hw1 & 0xFF) << 1, 9)) & 0xFFFFFFFF
+            elif (hw1 & 0xF800) == 0xE000:
+                # B (T2)
+                kind = THUMB_DIRECT
+                target = (addr + 4 + thumb_sext((hw1 & 0x7FF) << 1, 12)) & 0xFFFFFFFF
+            elif (hw1 & 0xF500) == 0xB100:
+                # CBZ/CBNZ
+                kind = THUMB_DIRECT
+                target = (addr + 4 + ((((hw1 >> 9) & 1) << 6) | (((hw1 >> 3) & 0x1F) << 1))) & 0xFFFFFFFF
+            elif (hw1 & 0xFF00) == 0x4700:
+                kind = THUMB_INDIRECT # BX/BLX Rm
+            elif (hw1 & 0xFF00) == 0xBD00:
+                kind = THUMB_INDIRECT # POP {..., pc}
+            elif (hw1 & 0xFF87) == 0x4687:
+                kind = THUMB_INDIRECT # MOV pc, Rm
+        ins = (size, kind, target)
+        self.cache[addr] = ins
+        return ins
+
+#------------------------------------------------------------------------------
+
+class ETMCtx:
+    def __init__(self, dstyle, ctxid_bytes=0, index=None):
+        self.dstyle = dstyle
+        self.ctxid_bytes = ctxid_bytes
+        self.index = index
+        self.kind = None # packet being collected
+        self.pkt = bytearray()
+        self.start_time = None
+        self.synced = False
+        self.address = 0 # compressed address reconstruction
+        # Execution reconstruction:
+        self.pc = None
+        self.range_start = None
+        self.range_count = 0
+        self.range_time = None
+        self.range_end_time = None
+        self.errors = 0
+
+    def packet_done(self, db):
+        # Returns True when the packet being collected is complete
+        kind = self.kind
+        pkt = self.pkt
+        plen = len(pkt)
+        if kind == ETMPkt.ASYNC:
+            return (db != 0x00)
+        if kind == ETMPkt.BRANCH:
+            return self.branch_done(plen)
+        if kind == ETMPkt.ISYNC:
+            return (plen == (1 + self.ctxid_bytes + 1 + 4))
+        if kind == ETMPkt.ISYNC_CC:
+            # Cycle count (1..5 bytes with continuation) before the I-sync body:
+            ccount = 0
+            idx = 1
+            while idx < plen:
+                ccount += 1
+                if not (pkt[idx] & 0x80) or ccount == 5:
+                    return (plen == (1 + ccount + self.ctxid_bytes + 1 + 4))
+                idx += 1
+            return False
+        if kind == ETMPkt.CYCLE:
+            return (plen > 1) and ((not (db & 0x80)) or (plen == 6))
+        if kind == ETMPkt.TIMESTAMP:
+            return (plen > 1) and ((not (db & 0x80)) or (plen == 10))
+        if kind == ETMPkt.CTXID:
+            return (plen == (1 + self.ctxid_bytes))
+        if kind == ETMPkt.VMID:
+            return (plen == 2)
+        return True
+
+    def branch_done(self, plen):
+        # Address bytes (up to 5, with continuation) followed by optional
+        # exception information bytes:
+        pkt = self.pkt
+        abytes = 1
+        while abytes < 5 and (pkt[abytes - 1] & 0x80):
+            if abytes == plen:
+                return False
+            abytes += 1
+        if abytes > plen:
+            return False
+        if abytes == 1 or not (pkt[abytes - 1] & 0x40):
+            return True
+        # Exception bytes continue while C is set (at most 3):
+        ebytes = plen - abytes
+        if ebytes == 0:
+            return False
+        return (not (pkt[-1] & 0x80)) or (ebytes == 3)
+
+    def branch(self):
+        pkt = self.pkt
+        addr = 0
+        shift = 1
+        nbits = 0
+        abytes = 0
+        for idx in range(min(len(pkt), 5)):
+            abytes += 1
+            bits = ETM_BRANCH_BITS[idx]
+            if idx == 0:
+                value = ((pkt[0] >> 1) & 0x3F)
+            elif idx == 4:
+                value = (pkt[4] & 0x0F)
+            else:
+                value = (pkt[idx] & 0x7F)
+                if not (pkt[idx] & 0x80):
+                    # Alternative encoding : bit6 flags exception information
+                    bits = 6
+                    value &= 0x3F
+            addr |= (value << shift)
+            shift += bits
+            nbits += bits
+            if idx < 4 and not (pkt[idx] & 0x80):
+                break
+        mask = ((1 << (nbits + 1)) - 1)
+        self.address = ((self.address & ~mask) | (addr & mask)) & 0xFFFFFFFE
+        exception = None
+        ebytes = pkt[abytes:]
+        if len(ebytes):
+            exception = ((ebytes[0] >> 1) & 0xF)
+            if len(ebytes) > 1:
+                exception |= ((ebytes[1] & 0x1F) << 4)
+        return (self.address, exception)
+
+    def isync(self):
+        pkt = self.pkt
+        offset = 1
+        if self.kind == ETMPkt.ISYNC_CC:
+            while (pkt[offset] & 0x80) and offset < 5:
+                offset += 1
+            offset += 1
+        ctxid = None
+        if self.ctxid_bytes:
+            ctxid = int.from_bytes(pkt[offset:offset + self.ctxid_bytes], 'little')
+            offset += self.ctxid_bytes
+        info = pkt[offset]
+        (addr,) = struct.unpack_from('<I', pkt, offset + 1)
+        self.address = (addr & 0xFFFFFFFE)
+        return (self.address, ((info >> 5) & 0x3), ctxid)
+
+    def range_flush(self, frames):
+        if self.range_start is not None and self.range_count:
+            data_str = '{0:08X}-{1:08X} {2:d} instr'.format(self.range_start, self.pc, self.range_count)
+            frames.append(AnalyzerFrame('exec', self.range_time, self.range_end_time, {'val': data_str }))
+        self.range_start = None
+        self.range_count = 0
+
+    def atoms(self, atoms, start_time, end_time, frames):
+        # Each ETMv3 atom is one instruction executed (E) or failing its
+        # condition code check (N):
+        index = self.index
+        for executed in atoms:
+            if self.pc is None:
+                return
+            ins = index.decode(self.pc)
+            if ins is None:
+                self.range_flush(frames)
+                data_str = 'No image for address {0:08X}'.format(self.pc)
+                frames.append(AnalyzerFrame('err', start_time, end_time, {'val': data_str }))
+                self.pc = None
+                return
+            if self.range_start is None:
+                self.range_start = self.pc
+                self.range_time = start_time
+            self.range_count += 1
+            self.range_end_time = end_time
+            (size, kind, target) = ins
+            self.pc += size
+            if executed and kind != THUMB_NORMAL:
+                self.range_flush(frames)
+                if kind == THUMB_DIRECT:
+                    self.pc = target
+                else:
+                    # Wait for the branch address packet
+                    self.pc = None
+
+    def process(self, start_time, end_time):
+        kind = self.kind
+        pkt = self.pkt
+        frames = []
+        exec_style = (self.dstyle is DecodeStyleETM.Execution)
+        data_str = None
+        if kind == ETMPkt.ASYNC:
+            if pkt[-1] == 0x80 and len(pkt) >= 6:
+                self.synced = True
+                data_str = 'A-SYNC'
+            else:
+                data_str = 'Bad A-SYNC'
+                frames.append(AnalyzerFrame('err', start_time, end_time, {'val': data_str }))
+                data_str = None
+        elif kind == ETMPkt.ISYNC or kind == ETMPkt.ISYNC_CC:
+            (addr, reason, ctxid) = self.isync()
+            data_str = 'I-SYNC {0:08X} {1:s}'.format(addr, ('periodic', 'enabled', 'overflow', 'debug')[reason])
+            if ctxid is not None:
+                data_str += ' ctx {0:X}'.format(ctxid)
+            if exec_style:
+                self.range_flush(frames)
+                self.pc = addr
+        elif kind == ETMPkt.BRANCH:
+            (addr, exception) = self.branch()
+            data_str = 'BRANCH {0:08X}'.format(addr)
+            if exception is not None:
+                data_str += ' EXC {0:d}'.format(exception)
+            if exec_style:
+                self.range_flush(frames)
+                self.pc = addr
+        elif kind == ETMPkt.PHDR1:
+            db = pkt[0]
+            ecount = ((db >> 2) & 0xF)
+            ncount = ((db >> 6) & 0x1)
+            data_str = 'ATOMS ' + ('E' * ecount) + ('N' * ncount)
+            if exec_style:
+                self.atoms(((True,) * ecount) + ((False,) * ncount), start_time, end_time, frames)
+        elif kind == ETMPkt.PHDR2:
+            db = pkt[0]
+            atoms = (not (db & 0x8), not (db & 0x4))
+            data_str = 'ATOMS ' + ''.join('E' if atom else 'N' for atom in atoms)
+            if exec_style:
+                self.atoms(atoms, start_time, end_time, frames)
+        elif kind == ETMPkt.CTXID:
+            data_str = 'CONTEXTID {0:X}'.format(int.from_bytes(pkt[1:], 'little'))
+        elif kind == ETMPkt.CYCLE or kind == ETMPkt.TIMESTAMP:
+            value = 0
+            for idx in range(1, len(pkt)):
+                value |= ((pkt[idx] & 0x7F) << (7 * (idx - 1)))
+            data_str = '{0:s} {1:d}'.format(ETMPKT_NAMES[kind], value)
+        elif kind == ETMPkt.RESERVED:
+            data_str = 'Reserved header {0:02X}'.format(pkt[0])
+            frames.append(AnalyzerFrame('err', start_time, end_time, {'val': data_str }))
+            data_str = None
+        else:
+            data_str = ETMPKT_NAMES[kind]
+        if data_str is not None and not exec_style:
+            frames.append(AnalyzerFrame('etm', start_time, end_time, {'val': data_str }))
+        return frames
+
+    def error_byte(self, start_time, end_time, count=1, reason='Framing error'):
+        # A bad byte may have been any part of any packet, and the ETM
+        # header encoding is too dense to guess the next packet boundary,
+        # so we drop everything up to the next A-sync.
+        self.errors += 1
+        self.kind = None
+        if not self.synced:
+            return None
+        self.synced = False
+        frames = []
+        self.range_flush(frames)
+        self.pc = None
+        data_str = '{0:s}: waiting for A-sync'.format(reason)
+        frames.append(AnalyzerFrame('err', start_time, end_time, {'val': data_str }))
+        return frames
+
+    def run_byte(self, db, start_time, end_time):
+        if self.kind is None:
+            kind = ETM_HEADERS[db]
+            if not self.synced and kind != ETMPkt.ASYNC:
+                # Discard until A-sync
+                return None
+            self.kind = kind
+            self.pkt.clear()
+            self.start_time = start_time
+        self.pkt.append(db)
+        if not self.packet_done(db):
+            return None
+        frames = self.process(self.start_time, end_time)
+        self.kind = None
+        if len(frames) == 0:
+            return None
         return frames
 
 #------------------------------------------------------------------------------
@@ -893,6 +2307,9 @@ class TPIU(HighLevelAnalyzer):
     result_types = {
         'tpiu': {
             'format': 'TPIU: {{data.val}}'
+        },
+        'err': {
+            'format': 'Error: {{data.val}}'
         }
     }
 
@@ -905,8 +2322,8 @@ class TPIU(HighLevelAnalyzer):
         # frame.data['data'] will be a bytes object
         # frame.data['error'] will be set if there was an error
 
-        # IMPLEMENT: Check for frame.data['error'] string and skip
-        # decoding if invalid source data
+        # A byte with a framing error is passed on (rather than skipped)
+        # so that the decoders can count it and resynchronise.
 
         # For AsyncSerial we expect the 'data' field to contain one byte
 
@@ -917,7 +2334,8 @@ class TPIU(HighLevelAnalyzer):
             self.ctx = TPIUCtx(tpdstyle, self.stream, self.offset)
 
         # Process bytes:
-        nf = self.ctx.process_byte(frame, frame.data['data'][0])
+        error = bool(frame.data.get('error'))
+        nf = self.ctx.process_byte(frame.data['data'][0], frame.start_time, frame.end_time, error)
         if nf is None:
             return
 
@@ -928,7 +2346,7 @@ class TPIU(HighLevelAnalyzer):
 
 class ITMDWT(HighLevelAnalyzer):
     # Decode style:
-    decode_style = ChoicesSetting(choices=('All', 'Port', 'Console', 'Instrumentation'))
+    decode_style = ChoicesSetting(choices=('All', 'Port', 'Console', 'Instrumentation', 'Timeline', 'Search', 'Counters'))
 
     # We can have 8 pages of 32-ports in each page
     port = NumberSetting(min_value=0, max_value=255)
@@ -940,6 +2358,33 @@ class ITMDWT(HighLevelAnalyzer):
     # Initial synchronisation:
     TPIU_offset = NumberSetting(min_value=0, max_value=15)
 
+    # Optional application ELF file providing the instrumentation record
+    # descriptors:
+    elf_file = StringSetting()
+
+    # Optional comma separated list of further instrumentation ports to
+    # be decoded alongside the port# setting:
+    inst_ports = StringSetting()
+
+    # Comma separated console search patterns (prefix "re:" for a regex):
+    search = StringSetting()
+
+    # Frequency of the instrumentation record timestamp timer for the
+    # Timeline style (0 to use the record capture times):
+    inst_timer_hz = NumberSetting(min_value=0, max_value=4000000000)
+
+    # Summary reporting window in milliseconds (0 to disable, or the
+    # default 1 second for Counters):
+    window_ms = NumberSetting(min_value=0, max_value=3600000)
+
+    # Number of CPU cycles per DWT POSTCNT wrap (0 if unknown):
+    postcnt_period = NumberSetting(min_value=0, max_value=(1 << 20))
+
+    # Maximum time in milliseconds that decoded data is held back
+    # waiting for the rest of a console line or instrumentation record
+    # (0 to hold indefinitely):
+    hold_ms = NumberSetting(min_value=0, max_value=60000)
+
     result_types = {
         'console': {
             'format': '{{data.val}}'
@@ -955,6 +2400,24 @@ class ITMDWT(HighLevelAnalyzer):
         },
         'ext': {
             'format': 'EXT: {{data.val}}'
+        },
+        'thread': {
+            'format': 'Thread: {{data.val}}'
+        },
+        'summary': {
+            'format': 'Summary: {{data.val}}'
+        },
+        'marker': {
+            'format': 'Match: {{data.val}}'
+        },
+        'rate': {
+            'format': 'Rate: {{data.val}}'
+        },
+        'partial': {
+            'format': '{{data.val}}...'
+        },
+        'pending': {
+            'format': 'Pending: {{data.val}}'
         }
     }
 
@@ -968,11 +2431,14 @@ class ITMDWT(HighLevelAnalyzer):
         # frame.data['data'] will be a bytes object
         # frame.data['error'] will be set if there was an error
 
-        # IMPLEMENT: Check for frame.data['error'] string and skip
-        # decoding if invalid source data
+        # A byte with a framing error is passed on (rather than skipped)
+        # so that the decoders can count it and resynchronise.
 
         # For AsyncSerial we expect the 'data' field to contain one byte
 
+        # A configuration error is reported (once) along with the
+        # output for the first byte, which is still decoded:
+        errf = None
         if self.ctx == None:
             dstyle = DecodeStyle.All # default
             if self.decode_style == 'Port':
@@ -981,35 +2447,71 @@ class ITMDWT(HighLevelAnalyzer):
                 dstyle = DecodeStyle.Console
             elif self.decode_style == 'Instrumentation':
                 dstyle = DecodeStyle.Instrumentation
+            elif self.decode_style == 'Timeline':
+                dstyle = DecodeStyle.Timeline
+            elif self.decode_style == 'Search':
+                dstyle = DecodeStyle.Search
+            elif self.decode_style == 'Counters':
+                dstyle = DecodeStyle.Counters
             self.ctx = PktCtx(frame.start_time, dstyle, self.port)
+            search = [p.strip() for p in (self.search or '').split(',') if p.strip()]
+            try:
+                self.ctx.configure((self.window_ms / 1000.0), (self.hold_ms / 1000.0), int(self.postcnt_period), search, self.inst_timer_hz)
+            except (re.error, ValueError) as ex:
+                # ValueError covers literal patterns not encodable as
+                # the (latin-1) console bytes
+                data_str = 'Bad search pattern: {0:s}'.format(str(ex))
+                errf = AnalyzerFrame('err', frame.start_time, frame.end_time, {'val': data_str })
+            if (dstyle is DecodeStyle.Instrumentation or dstyle is DecodeStyle.Timeline) and self.inst_ports:
+                try:
+                    self.ctx.inst_ports = set(int(p, 0) for p in self.inst_ports.split(',') if p.strip())
+                except ValueError:
+                    data_str = 'Bad instrumentation port list "{0:s}"'.format(self.inst_ports)
+                    errf = AnalyzerFrame('err', frame.start_time, frame.end_time, {'val': data_str })
+            if (dstyle is DecodeStyle.Instrumentation or dstyle is DecodeStyle.Timeline) and self.elf_file:
+                try:
+                    self.ctx.inst_layouts = inst_load_layouts(self.elf_file)
+                except (OSError, ValueError, struct.error) as ex:
+                    data_str = 'ELF {0:s}: {1:s} : records shown as raw data'.format(self.elf_file, str(ex))
+                    errf = AnalyzerFrame('err', frame.start_time, frame.end_time, {'val': data_str })
 
         # Progress FSM:
         nf = None
 
+        # Bound the latency of held (partially decoded) output. When
+        # unwrapping TPIU we only check at the start of each formatter
+        # frame; on a quiet link the TPIU continues to output idle fill
+        # frames, so the check is still made regularly.
+        held = None
+        if self.ctx.hold:
+            if self.tpiu == None or self.tpiu.bidx == 0:
+                held = self.ctx.flush(frame.start_time)
+
         # We may need to unwrap from a TPIU stream encoding:
         if self.TPIU_stream != 0:
             if self.tpiu == None:
-                self.tpiu = TPIUCtx(DecodeStyleTPIU.Saleae, self.TPIU_stream, self.TPIU_offset)
-            tframes = self.tpiu.process_byte(frame, frame.data['data'][0])
-            if tframes is None:
-                nf = None
-            else:
-                if isinstance(tframes, list):
-                    nf = []
-                    for idx in range(len(tframes)):
-                        if tframes[idx].type == 'data':
-                            iframe = self.ctx.run(tframes[idx])
-                            if iframe != None:
-                                if isinstance(iframe, list):
-                                    nf += iframe
-                                else:
-                                    nf.append(iframe)
-                                #nf.append(iframe)
-                else:
-                    nf = None
+                self.tpiu = TPIUCtx(DecodeStyleTPIU.Saleae, self.TPIU_stream, self.TPIU_offset, self.ctx)
+            error = bool(frame.data.get('error'))
+            # TPIU level frames (syncs and formatter errors) are not
+            # output; the unwrapped stream is decoded by self.ctx:
+            self.tpiu.process_byte(frame.data['data'][0], frame.start_time, frame.end_time, error)
+            if self.tpiu.decoded:
+                nf = self.tpiu.decoded
+                self.tpiu.decoded = []
         else:
             nf = self.ctx.run(frame)
 
+        if errf is not None:
+            held = [errf] + (held or [])
+
+        if held:
+            if nf is None:
+                nf = held
+            elif isinstance(nf, list):
+                nf = held + nf
+            else:
+                nf = held + [nf]
+
         if nf is None:
             #if self.no_match_start_time is None:
             #    self.no_match_start_time = frame.start_time
@@ -1018,5 +2520,76 @@ class ITMDWT(HighLevelAnalyzer):
 
         return nf
 
+#------------------------------------------------------------------------------
+# ETM instruction trace decoding
+
+class ETM(HighLevelAnalyzer):
+    # Decode style:
+    etm_decode_style = ChoicesSetting(choices=('Packets', 'Execution'))
+
+    # TPIU stream ID carrying the ETM trace:
+    TPIU_stream = NumberSetting(min_value=1, max_value=126)
+
+    # Initial synchronisation:
+    TPIU_offset = NumberSetting(min_value=0, max_value=15)
+
+    # Application ELF file (required for Execution decoding):
+    elf_file = StringSetting()
+
+    # Size of the Context ID in I-sync and Context ID packets (as
+    # configured in the ETMCR):
+    ctxid_bytes = NumberSetting(min_value=0, max_value=4)
+
+    result_types = {
+        'etm': {
+            'format': 'ETM: {{data.val}}'
+        },
+        'exec': {
+            'format': 'Exec: {{data.val}}'
+        },
+        'err': {
+            'format': 'Error: {{data.val}}'
+        }
+    }
+
+    def __init__(self):
+        self.ctx = None
+        self.tpiu = None
+        pass
+
+    def decode(self, frame: AnalyzerFrame):
+        errf = None
+        if self.ctx == None:
+            dstyle = DecodeStyleETM.Packets # default
+            index = None
+            if self.etm_decode_style == 'Execution':
+                # If the ELF file cannot be used the error is reported
+                # once and we fall back to Packets decoding:
+                data_str = None
+                if not self.elf_file:
+                    data_str = 'Execution decoding requires an ELF file'
+                else:
+                    try:
+                        with open(self.elf_file, 'rb') as fh:
+                            index = ThumbIndex(ElfFile(fh.read()))
+                        dstyle = DecodeStyleETM.Execution
+                    except (OSError, ValueError, struct.error) as ex:
+                        data_str = 'ELF {0:s}: {1:s}'.format(self.elf_file, str(ex))
+                if data_str is not None:
+                    errf = AnalyzerFrame('err', frame.start_time, frame.end_time, {'val': data_str + ' : decoding Packets'})
+            self.ctx = ETMCtx(dstyle, int(self.ctxid_bytes), index)
+            self.tpiu = TPIUCtx(DecodeStyleTPIU.Saleae, self.TPIU_stream, self.TPIU_offset, self.ctx)
+
+        error = bool(frame.data.get('error'))
+        self.tpiu.process_byte(frame.data['data'][0], frame.start_time, frame.end_time, error)
+        if len(self.tpiu.decoded) == 0:
+            return errf
+
+        nf = self.tpiu.decoded
+        self.tpiu.decoded = []
+        if errf is not None:
+            nf = [errf] + nf
+        return nf
+
 #------------------------------------------------------------------------------
 #> EOF debug.py
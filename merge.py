@@ -0,0 +1,199 @@
+# Timestamp ordered merge of multiple trace sources
+#
+# Multi-core parts provide an ITM/DWT stream per core, either as
+# separate TPIU stream IDs within one SWO capture or as separate SWO
+# captures. Each source is decoded (see swo.py) in its own process, the
+# decoded frames are placed on a common timebase and then k-way merged
+# into a single ordered output with each frame tagged by its source.
+#
+# Example usage:
+#
+#  $ python merge.py --source core0=swo.bin,stream=1 --source core1=swo.bin,stream=2
+#
+# Source options (comma separated after the capture file name):
+#  stream=N   TPIU stream (default 0 for BYPASS)
+#  offset=N   TPIU initial offset
+#  style=S    ITM/DWT decode style (default All)
+#  port=N     ITM port for the decode style
+#  baud=N     SWO baud rate (default estimated)
+#  skew=S     seconds added to the capture time to align captures
+#  window=S   summary window in seconds (e.g. for the Counters style)
+#  postcnt=N  CPU cycles per DWT POSTCNT wrap (for the Counters style)
+#  search=P   console search patterns for the Search style, separated
+#             by ';' (as ',' separates the source options)
+#
+# If --gts-hz is given then sources that output DWT global timestamp
+# (GTS) packets are placed on the reconstructed global timebase (with
+# the capture time used until the first GTS packet is seen). Each frame
+# is timed against the GTS state when it was decoded, and a source's
+# frame times are never allowed to go backwards (as can happen when
+# switching to, or between, GTS references) since the merge relies on
+# each source being in time order.
+
+import argparse
+import heapq
+import multiprocessing
+import sys
+
+from debug import AnalyzerFrame, DecodeStyle, PktKind
+from swo import SWODecoder, decode_nrz_windows, estimate_baud, load_edges
+
+# Decoded bytes fed to a source decoder per step, and the number of
+# batches of frames a source can queue ahead of the merge before it is
+# blocked (bounding memory use when one source is far ahead of another):
+MERGE_CHUNK = (1 << 16)
+MERGE_QUEUE = 8
+
+class MergeSource:
+    def __init__(self, spec):
+        (self.tag, sep, rest) = spec.partition('=')
+        if not sep or not rest:
+            raise ValueError('Bad source "{0:s}" : expected TAG=CAPTURE[,option=value...]'.format(spec))
+        options = rest.split(',')
+        self.capture = options[0]
+        self.stream = 0
+        self.offset = 0
+        self.dstyle = DecodeStyle.All
+        self.port = 0
+        self.baud = 0
+        self.skew = 0.0
+        self.window = 0.0
+        self.postcnt_period = 0
+        self.search = []
+        for option in options[1:]:
+            (name, sep, value) = option.partition('=')
+            if name == 'stream':
+                self.stream = int(value, 0)
+            elif name == 'offset':
+                self.offset = int(value, 0)
+            elif name == 'style':
+                self.dstyle = DecodeStyle[value]
+            elif name == 'port':
+                self.port = int(value, 0)
+            elif name == 'baud':
+                self.baud = float(value)
+            elif name == 'skew':
+                self.skew = float(value)
+            elif name == 'window':
+                self.window = float(value)
+            elif name == 'postcnt':
+                self.postcnt_period = int(value, 0)
+            elif name == 'search':
+                self.search = [p for p in value.split(';') if p]
+            else:
+                raise ValueError('Bad source option "{0:s}"'.format(option))
+        if self.dstyle is DecodeStyle.Search and not self.search:
+            raise ValueError('Source "{0:s}" : the Search style requires search=PATTERN[;PATTERN...]'.format(self.tag))
+
+class GTSStamp:
+    # GTS packet subscriber : marks the point in the decoded frames at
+    # which the source's global timebase changes
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.gts_time = None
+        ctx.subscribe((PktKind.GLOBAL_TS1, PktKind.GLOBAL_TS2), self.packet)
+
+    def packet(self, pkt):
+        ctx = self.ctx
+        if ctx.gts_time is None or ctx.gts_time == self.gts_time:
+            return None
+        self.gts_time = ctx.gts_time
+        return AnalyzerFrame('gts', pkt.start_time, pkt.end_time, {'gts': ctx.global_time(), 'time': ctx.gts_time})
+
+class SourceError(Exception):
+    pass
+
+def decode_source(source, queue, gts_hz):
+    # Source process : frames are passed back as (time, tag, type, val)
+    # tuples in batches, terminated by None. A failure is passed back as
+    # an ('error', message) tuple instead, so that the merge is never
+    # left waiting on a dead source nor mistakes it for the end of the
+    # source. The capture is decoded a window of edges at a time so
+    # memory use does not grow with the capture length.
+    try:
+        initial_state, begin_time, times = load_edges(source.capture)
+        baud = source.baud
+        if not baud:
+            baud = estimate_baud(times)
+        decoder = SWODecoder(source.dstyle, source.port, source.stream, source.offset, source.window, source.postcnt_period, source.search)
+        if gts_hz:
+            GTSStamp(decoder.ctx)
+        timebase = None
+        last = None
+        for (data, starts, ends, errors) in decode_nrz_windows(initial_state, times, baud):
+            for lo in range(0, len(data), MERGE_CHUNK):
+                hi = lo + MERGE_CHUNK
+                batch = []
+                for nf in decoder.feed(data[lo:hi], starts[lo:hi], ends[lo:hi], errors[lo:hi]):
+                    if nf.type == 'gts':
+                        timebase = ((nf.data['gts'] / gts_hz), nf.data['time'])
+                        continue
+                    # Frames are emitted as their last byte is decoded, so the
+                    # end time is monotonic within a source:
+                    when = nf.end_time + source.skew
+                    if timebase is not None:
+                        when = timebase[0] + (nf.end_time - timebase[1])
+                    if last is not None and when < last:
+                        when = last
+                    last = when
+                    batch.append( (when, source.tag, nf.type, str(nf.data.get('val', ''))) )
+                if batch:
+                    queue.put(batch)
+    except BaseException as ex:
+        queue.put( ('error', '{0:s}: {1:s}'.format(type(ex).__name__, str(ex))) )
+        return
+    queue.put(None)
+
+def source_frames(tag, queue):
+    while True:
+        batch = queue.get()
+        if batch is None:
+            return
+        if isinstance(batch, tuple):
+            raise SourceError('source "{0:s}" : {1:s}'.format(tag, batch[1]))
+        yield from batch
+
+def merge(sources, gts_hz=0.0):
+    # Returns a generator of (time, tag, type, val) in time order
+    ctx = multiprocessing.get_context('spawn')
+    workers = []
+    streams = []
+    for source in sources:
+        queue = ctx.Queue(MERGE_QUEUE)
+        worker = ctx.Process(target=decode_source, args=(source, queue, gts_hz), daemon=True)
+        worker.start()
+        workers.append(worker)
+        streams.append(source_frames(source.tag, queue))
+    try:
+        yield from heapq.merge(*streams, key=lambda item: item[0])
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge ITM/DWT trace sources into a single time ordered stream')
+    parser.add_argument('--source', action='append', required=True, help='TAG=CAPTURE[,option=value...]')
+    parser.add_argument('--gts-hz', type=float, default=0.0, help='global timestamp clock frequency')
+    args = parser.parse_args(argv)
+
+    try:
+        sources = [MergeSource(spec) for spec in args.source]
+    except (ValueError, KeyError) as ex:
+        parser.error(str(ex))
+    try:
+        for (when, tag, ftype, val) in merge(sources, args.gts_hz):
+            sys.stdout.write('{0:.9f} {1:s} {2:s} {3:s}\n'.format(when, tag, ftype, val))
+    except SourceError as ex:
+        # The output is incomplete:
+        sys.stdout.flush()
+        sys.stderr.write('merge.py: error: {0:s}\n'.format(str(ex)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+#------------------------------------------------------------------------------
+#> EOF merge.py
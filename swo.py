@@ -0,0 +1,264 @@
+# Offline SWO decoding from raw sampled channel data
+#
+# Logic2 normally provides the Async Serial low-level analyser to turn
+# the SWO pin transitions into byte frames for the debug.py high-level
+# analysers. For offline processing of long captures we instead decode
+# the NRZ (UART 8N1) encoding directly from an exported array of edge
+# timestamps using NumPy, and feed the resulting bytes through the same
+# TPIUCtx/PktCtx decoders.
+#
+# Example usage:
+#
+#  $ python swo.py --stream 1 --style Console --port 31 digital.bin
+#
+# where digital.bin is a Logic2 binary (or CSV) export of the SWO channel.
+
+import argparse
+import re
+import struct
+import sys
+
+import numpy as np
+
+from debug import DecodeStyle, DecodeStyleTPIU, PktCtx, TPIUCtx
+
+# UART 8N1 character: start bit, 8 data bits (LSB first) and a stop bit.
+NRZ_BITS = 10
+NRZ_STOP = 9
+
+# Number of start bits processed per vectorized step. This bounds the
+# size of the (chunk x NRZ_BITS) bit-centre sampling arrays.
+NRZ_CHUNK = (1 << 18)
+
+# Number of following falling edges checked for the next start bit.
+NRZ_LOOKAHEAD = 8
+
+# Number of edges used to estimate the baud rate.
+NRZ_ESTIMATE = (1 << 20)
+
+# Number of edges decoded per window by decode_nrz_windows.
+NRZ_WINDOW = (1 << 22)
+
+#------------------------------------------------------------------------------
+# Capture loading
+
+def load_edges(path):
+    # Returns (initial_state, begin_time, edge_times)
+    with open(path, 'rb') as fh:
+        ident = fh.read(8)
+        if ident == b'<SALEAE>':
+            # Logic2 binary export (version 0) of a single digital channel:
+            version, dtype, initial_state, begin_time, end_time, num_transitions = struct.unpack('<iiIddQ', fh.read(36))
+            if version != 0 or dtype != 0:
+                raise ValueError('{0:s}: unsupported Saleae export version {1:d} type {2:d}'.format(path, version, dtype))
+            # The edge times are mapped rather than read so that long
+            # captures can be processed in windows (see decode_nrz_windows):
+            if num_transitions == 0:
+                return (initial_state & 1, begin_time, np.empty(0, dtype=np.float64))
+            times = np.memmap(path, dtype='<f8', mode='r', offset=(8 + 36), shape=(num_transitions,))
+            return (initial_state & 1, begin_time, times)
+
+    # Otherwise expect a Logic2 CSV export of (time, state) rows:
+    rows = np.loadtxt(path, delimiter=',', skiprows=1, usecols=(0, 1), ndmin=2)
+    if len(rows) == 0:
+        raise ValueError('{0:s}: no samples'.format(path))
+    states = rows[:, 1].astype(np.uint8)
+    changes = np.flatnonzero(np.diff(states)) + 1
+    return (int(states[0]) & 1, rows[0, 0], rows[changes, 0])
+
+#------------------------------------------------------------------------------
+# NRZ decoding
+
+def estimate_baud(times):
+    # The shortest commonly occurring interval between edges is a single
+    # bit period. Every interval should then be a whole number (1..9) of
+    # bit periods, so we refine the estimate over all of those intervals.
+    dt = np.diff(times[:NRZ_ESTIMATE])
+    if len(dt) == 0:
+        raise ValueError('Not enough edges to estimate baud rate')
+    shortest = np.percentile(dt, 1)
+    bit = np.median(dt[dt < (1.5 * shortest)])
+    nbits = np.rint(dt / bit)
+    valid = (nbits >= 1) & (nbits < NRZ_BITS)
+    if np.any(valid):
+        bit = dt[valid].sum() / nbits[valid].sum()
+    return 1.0 / bit
+
+def start_bits(falls, bit):
+    # A start bit is the first falling edge after the middle of the
+    # previous character's stop bit. That is a sequential dependency, so
+    # we compute the "next start" link for every falling edge and then
+    # follow the chain from the first edge by pointer doubling.
+    nfalls = len(falls)
+    if nfalls == 0:
+        return np.empty(0, dtype=np.int64)
+    # Falling edges are at least 2 bits apart, so only the next few can
+    # be within a character of any given edge:
+    limit = falls + ((NRZ_STOP + 0.5) * bit)
+    padded = np.append(falls, np.full(NRZ_LOOKAHEAD, np.inf))
+    nxt = np.arange(1, nfalls + 1)
+    for idx in range(1, NRZ_LOOKAHEAD + 1):
+        nxt += (padded[idx:idx + nfalls] <= limit)
+    chains = []
+    first = 0
+    while first < nfalls:
+        lo = first
+        hi = min(lo + NRZ_CHUNK, nfalls)
+        size = hi - lo
+        # Local links with a sentinel (size) for links leaving the chunk:
+        jump = np.minimum(nxt[lo:hi] - lo, size)
+        jump = np.append(jump, size)
+        path = np.zeros(1, dtype=np.int64)
+        while path[-1] != size:
+            path = np.concatenate((path, jump[path]))
+            jump = jump[jump]
+        path = path[path < size]
+        chains.append(path + lo)
+        first = nxt[lo + path[-1]]
+    return np.concatenate(chains)
+
+def decode_nrz(initial_state, times, baud):
+    # Returns (data, starts, ends, errors) arrays for the decoded bytes,
+    # with errors flagging characters with a bad start or stop bit.
+    bit = 1.0 / baud
+    times = np.asarray(times, dtype=np.float64)
+    # Edge i leaves the line at level (initial_state ^ ((i + 1) & 1)):
+    first_fall = 0 if initial_state else 1
+    falls = times[first_fall::2]
+    edges = first_fall + (2 * start_bits(falls, bit))
+    starts = times[edges]
+
+    # A character has at most NRZ_BITS edges (including its start bit
+    # edge), each on a bit boundary. We build a mask of the boundaries
+    # where the line toggles, and a prefix XOR of that mask then gives
+    # the line level at every bit centre.
+    padded = np.append(times, np.full(NRZ_BITS, np.inf))
+    window = np.arange(NRZ_BITS)
+    data = np.empty(len(starts), dtype=np.uint8)
+    errors = np.empty(len(starts), dtype=bool)
+    for lo in range(0, len(starts), NRZ_CHUNK):
+        hi = min(lo + NRZ_CHUNK, len(starts))
+        wedges = padded[edges[lo:hi, None] + window[None, :]]
+        boundary = np.rint((wedges - starts[lo:hi, None]) / bit)
+        boundary = np.where(boundary < NRZ_BITS, boundary, NRZ_BITS + 1).astype(np.int64)
+        toggles = np.bitwise_xor.reduce(np.left_shift(1, boundary), axis=1)
+        toggles ^= (toggles << 1)
+        toggles ^= (toggles << 2)
+        toggles ^= (toggles << 4)
+        toggles ^= (toggles << 8)
+        # The line was high (idle or stop bit) before the start bit:
+        levels = ~toggles
+        data[lo:hi] = ((levels >> 1) & 0xFF)
+        errors[lo:hi] = ((levels & 1) != 0) | (((levels >> NRZ_STOP) & 1) != 1)
+    ends = starts + (NRZ_BITS * bit)
+    return (data, starts, ends, errors)
+
+def decode_nrz_windows(initial_state, times, baud, window=NRZ_WINDOW):
+    # Generator of decode_nrz() results for successive windows of edges,
+    # bounding the memory used for long captures. Only the characters
+    # that are complete within a window are returned, and the next
+    # window starts at the first edge after the middle of the stop bit
+    # of the last of those.
+    bit = 1.0 / baud
+    nedges = len(times)
+    lo = 0
+    state = initial_state
+    while lo < nedges:
+        hi = min(lo + window, nedges)
+        wtimes = np.asarray(times[lo:hi], dtype=np.float64)
+        (data, starts, ends, errors) = decode_nrz(state, wtimes, baud)
+        if hi == nedges:
+            yield (data, starts, ends, errors)
+            return
+        ncomplete = np.searchsorted(starts, wtimes[-1] - (NRZ_BITS * bit))
+        if ncomplete:
+            resume = starts[ncomplete - 1] + ((NRZ_STOP + 0.5) * bit)
+            yield (data[:ncomplete], starts[:ncomplete], ends[:ncomplete], errors[:ncomplete])
+        else:
+            resume = wtimes[-1] - (NRZ_BITS * bit)
+        skip = max(int(np.searchsorted(wtimes, resume, side='right')), 1)
+        # The line level before edge (lo + skip):
+        state ^= (skip & 1)
+        lo += skip
+
+#------------------------------------------------------------------------------
+# Bulk ITM/DWT decoding
+
+class SWODecoder:
+    def __init__(self, dstyle=DecodeStyle.All, port=0, stream=0, offset=0, window=0.0, postcnt_period=0, search=None):
+        self.ctx = PktCtx(None, dstyle, port)
+        # May raise re.error or ValueError for bad search patterns:
+        self.ctx.configure(window, 0.0, postcnt_period, search)
+        self.tpiu = None
+        if stream != 0:
+            self.tpiu = TPIUCtx(DecodeStyleTPIU.Saleae, stream, offset, self.ctx)
+
+    def feed(self, data, starts, ends, errors=None):
+        frames = []
+        ctx = self.ctx
+        tpiu = self.tpiu
+        if errors is None:
+            errors = np.zeros(len(data), dtype=bool)
+        if tpiu is not None:
+            # Frames decoded from the unwrapped stream are collected
+            # directly into our output:
+            tpiu.decoded = frames
+            for (db, start_time, end_time, error) in zip(data.tolist(), starts.tolist(), ends.tolist(), errors.tolist()):
+                tpiu.process_byte(db, start_time, end_time, error)
+            tpiu.decoded = []
+            return frames
+        for (db, start_time, end_time, error) in zip(data.tolist(), starts.tolist(), ends.tolist(), errors.tolist()):
+            if error:
+                nf = ctx.error_byte(start_time, end_time)
+            else:
+                nf = ctx.run_byte(db, start_time, end_time)
+            if nf != None:
+                if isinstance(nf, list):
+                    frames += nf
+                else:
+                    frames.append(nf)
+        return frames
+
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Decode ITM/DWT from a raw SWO channel capture')
+    parser.add_argument('capture', help='Logic2 binary or CSV export of the SWO channel')
+    parser.add_argument('--baud', type=float, default=0, help='SWO baud rate (default: estimated)')
+    parser.add_argument('--style', choices=[ds.name for ds in DecodeStyle], default='All')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--stream', type=int, default=0, help='TPIU stream (0 for BYPASS)')
+    parser.add_argument('--offset', type=int, default=0, help='TPIU initial offset')
+    parser.add_argument('--window-ms', type=float, default=0, help='summary window')
+    parser.add_argument('--search', default='', help='comma separated console search patterns (prefix "re:" for a regex)')
+    parser.add_argument('--postcnt-period', type=int, default=0, help='CPU cycles per DWT POSTCNT wrap (for Counters)')
+    args = parser.parse_args(argv)
+
+    search = [p.strip() for p in args.search.split(',') if p.strip()]
+    try:
+        decoder = SWODecoder(DecodeStyle[args.style], args.port, args.stream, args.offset, (args.window_ms / 1000.0), args.postcnt_period, search)
+    except (re.error, ValueError) as ex:
+        parser.error('Bad search pattern: {0:s}'.format(str(ex)))
+
+    initial_state, begin_time, times = load_edges(args.capture)
+    baud = args.baud
+    if not baud:
+        baud = estimate_baud(times)
+        sys.stderr.write('Estimated baud {0:.0f}\n'.format(baud))
+    # Decode window by window, so that only the edges of the capture are
+    # held in memory rather than the decoded bytes and frames as well:
+    nerrors = 0
+    for (data, starts, ends, errors) in decode_nrz_windows(initial_state, times, baud):
+        nerrors += int(np.count_nonzero(errors))
+        for nf in decoder.feed(data, starts, ends, errors):
+            sys.stdout.write('{0:.9f} {1:.9f} {2:s} {3:s}\n'.format(nf.start_time, nf.end_time, nf.type, str(nf.data.get('val', ''))))
+    if nerrors:
+        sys.stderr.write('{0:d} framing errors\n'.format(nerrors))
+    if decoder.tpiu is not None and decoder.tpiu.bad_bytes:
+        sys.stderr.write('{0:d} TPIU stream bytes invalidated by framing errors\n'.format(decoder.tpiu.bad_bytes))
+
+if __name__ == '__main__':
+    main()
+
+#------------------------------------------------------------------------------
+#> EOF swo.py
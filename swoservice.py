@@ -0,0 +1,586 @@
+# Live ITM/DWT decoding service
+#
+# Decodes a live SWO byte stream outside of Logic2, for example from the
+# TCP SWO port provided by a debug probe server, and fans the decoded
+# frames out to any number of local subscribers. Subscribers connect to
+# per-format listening sockets:
+#
+#  console  "TIME TYPE VAL" text lines (a console tail)
+#  json     one JSON object per decoded frame (e.g. to a JSON lines file)
+#  metrics  one JSON object per metrics interval with the decode rate,
+#           lag and per-subscriber queue statistics
+#
+# Example usage:
+#
+#  $ python swoservice.py --source tcp:localhost:2332 --stream 1 --baud 8000000 \
+#        --listen console=7001 --listen json=7002,policy=block --listen metrics=7003
+#  $ nc localhost 7001
+#
+# Listener options (comma separated after the port number):
+#  queue=N    number of decoded batches queued for each subscriber
+#  policy=P   action when a subscriber's queue is full:
+#             block  wait for the subscriber (holding up the decoding)
+#             oldest drop the oldest queued batch
+#             newest drop the new batch
+#
+# The source is either "tcp:HOST:PORT" or the path of a pipe (or "-" for
+# stdin). The source is read continuously into a bounded backlog, and
+# queued chunks are decoded in bulk. When the backlog is full source
+# data is dropped, and the gap is reported in the decoded output (as an
+# "Overrun" err frame) and in the metrics. If the SWO baud rate is given
+# then frame times are the position of each byte in the stream (in
+# seconds from the start of the stream), otherwise all of the bytes of a
+# batch are given the (monotonic) time its first chunk arrived.
+#
+# The service reports its own lag: the time from a chunk arriving to its
+# decoded frames being queued for the subscribers, and (when the baud
+# rate is known) how far the decoded stream time trails the wall clock
+# time since the start of the stream. The latter only indicates falling
+# behind for a continuous stream, such as a TPIU formatted SWO output
+# which sends idle fill frames when there is no trace data.
+#
+# The pure Python decoder sustains roughly 650KB/s for the All style
+# and 950KB/s for Console on a single CPU, against the 800KB/s of a
+# fully loaded 8MHz SWO link (see the README for the measurements).
+# Decoding can be moved to a worker process (--process) on a multi-core
+# host.
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import re
+import sys
+import time
+
+from debug import AnalyzerFrame, DecodeStyle, DecodeStyleTPIU, PktCtx, TPIUCtx
+
+# UART 8N1 character length in bits:
+SWO_BYTE_BITS = 10
+
+# Source read size, the largest batch of queued source data decoded in
+# one go, and the default limit on source data waiting to be decoded
+# (beyond which source data is dropped):
+SERVICE_CHUNK = (1 << 16)
+SERVICE_BATCH = (4 * SERVICE_CHUNK)
+SERVICE_BACKLOG = (8 << 20)
+
+# Default per-subscriber queue depth (in decoded batches) and the
+# default full queue policy for each format:
+SERVICE_QUEUE = 64
+SERVICE_POLICY = {
+    'console': 'oldest',
+    'json': 'block',
+    'metrics': 'oldest'
+}
+
+#------------------------------------------------------------------------------
+# Bulk decoding
+
+class LiveDecoder:
+    def __init__(self, dstyle=DecodeStyle.All, port=0, stream=0, offset=0, baud=0.0, hold=0.0, window=0.0, search=None, postcnt_period=0):
+        self.ctx = PktCtx(None, dstyle, port)
+        # May raise re.error or ValueError for bad search patterns:
+        self.ctx.configure(window, hold, postcnt_period, search)
+        self.tpiu = None
+        if stream != 0:
+            self.tpiu = TPIUCtx(DecodeStyleTPIU.Saleae, stream, offset, self.ctx)
+        self.bytetime = 0.0
+        if baud:
+            self.bytetime = (SWO_BYTE_BITS / baud)
+        self.nbytes = 0
+        self.dropped = 0
+
+    def stream_time(self):
+        return (self.nbytes * self.bytetime)
+
+    def status(self):
+        # Decoder state reported in the service metrics
+        status = {'errors': self.ctx.errors, 'stream_time': self.stream_time()}
+        if self.tpiu is not None:
+            status['tpiu_frames'] = self.tpiu.frames
+            status['tpiu_idle'] = self.tpiu.idle_frames
+            status['tpiu_bad_bytes'] = self.tpiu.bad_bytes
+        return status
+
+    def decode(self, chunk, when, kinds):
+        # Decodes a chunk, or accounts for a number of bytes dropped
+        # before decoding, returning the number of frames decoded, the
+        # formatted output for each of the given formats and our status
+        if isinstance(chunk, int):
+            frames = self.skip(chunk, when)
+        else:
+            frames = self.feed(chunk, when)
+        blobs = {}
+        if frames:
+            for kind in kinds:
+                fmt = SERVICE_FORMATS.get(kind)
+                if fmt is not None:
+                    blobs[kind] = fmt(frames)
+        return (len(frames), blobs, self.status())
+
+    def run(self, loop, chunk, when, kinds):
+        # Decodes in a worker thread, which shares the interpreter (and
+        # so a single CPU) with the event loop
+        return loop.run_in_executor(None, self.decode, chunk, when, kinds)
+
+    def close(self):
+        pass
+
+    def skip(self, nbytes, when):
+        # Returns the frames reporting nbytes missing from the stream.
+        # The stream time still advances over the gap. The decoders drop
+        # any partial packet, reporting the bytes discarded (with the
+        # same reason) once they have resynchronised.
+        start_time = when
+        end_time = when
+        if self.bytetime:
+            start_time = self.stream_time()
+            end_time = start_time + (nbytes * self.bytetime)
+        self.nbytes += nbytes
+        self.dropped += nbytes
+        data_str = 'Overrun: {0:d} bytes dropped (total {1:d})'.format(nbytes, self.dropped)
+        frames = [AnalyzerFrame('err', start_time, end_time, {'val': data_str, 'dropped': nbytes })]
+        if self.tpiu is not None:
+            frames += self.tpiu.skip(nbytes, start_time, end_time)
+        else:
+            self.ctx.error_byte(start_time, end_time, 0, 'Overrun')
+        return frames
+
+    def feed(self, chunk, when):
+        # Returns the list of frames decoded from the chunk
+        frames = []
+        ctx = self.ctx
+        tpiu = self.tpiu
+        bytetime = self.bytetime
+        start_time = when
+        end_time = when
+        if bytetime:
+            end_time = self.stream_time()
+        if tpiu is None:
+            for db in chunk:
+                if bytetime:
+                    start_time = end_time
+                    end_time += bytetime
+                nf = ctx.run_byte(db, start_time, end_time)
+                if nf != None:
+                    if isinstance(nf, list):
+                        frames += nf
+                    else:
+                        frames.append(nf)
+        else:
+            # Frames decoded from the unwrapped stream are collected
+            # directly into our output:
+            tpiu.decoded = frames
+            pos = 0
+            count = len(chunk)
+            while pos < count:
+                if tpiu.bidx == 0 and (count - pos) >= 16:
+                    # Whole TPIU frames:
+                    packet = []
+                    for db in chunk[pos:(pos + 16)]:
+                        if bytetime:
+                            start_time = end_time
+                            end_time += bytetime
+                        packet.append( (db, start_time, end_time) )
+                    tpiu.process_frame(packet)
+                    pos += 16
+                else:
+                    if bytetime:
+                        start_time = end_time
+                        end_time += bytetime
+                    tpiu.process_byte(chunk[pos], start_time, end_time)
+                    pos += 1
+            tpiu.decoded = []
+        self.nbytes += len(chunk)
+        if ctx.hold:
+            frames += ctx.flush(end_time)
+        return frames
+
+# The decoder owned by a DecodeProcess worker:
+worker_decoder = None
+
+def worker_init(args):
+    global worker_decoder
+    worker_decoder = LiveDecoder(*args)
+
+def worker_decode(chunk, when, kinds):
+    return worker_decoder.decode(chunk, when, kinds)
+
+class DecodeProcess:
+    # Runs a LiveDecoder (constructed from the same arguments) in a
+    # worker process, so that decoding has a CPU to itself and the event
+    # loop is left to read the source and service the subscribers. Only
+    # the raw chunks and the formatted output cross the process boundary.
+    # The worker is spawned rather than forked, since a forked worker
+    # would hold copies of the subscriber sockets open (and so they
+    # would never see the end of the stream).
+    def __init__(self, *args):
+        context = multiprocessing.get_context('spawn')
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context, initializer=worker_init, initargs=(args,))
+
+    def run(self, loop, chunk, when, kinds):
+        return loop.run_in_executor(self.executor, worker_decode, chunk, when, kinds)
+
+    def close(self):
+        self.executor.shutdown()
+
+#------------------------------------------------------------------------------
+# Subscribers
+
+def format_console(frames):
+    return ''.join('{0:.9f} {1:s} {2:s}\n'.format(nf.end_time, nf.type, str(nf.data.get('val', ''))) for nf in frames).encode()
+
+# Shared encoder (json.dumps() would construct one for every frame):
+JSON_ENCODER = json.JSONEncoder(default=str)
+
+def format_json(frames):
+    encode = JSON_ENCODER.encode
+    return ''.join(encode({'start': nf.start_time, 'end': nf.end_time, 'type': nf.type, 'data': nf.data}) + '\n' for nf in frames).encode()
+
+SERVICE_FORMATS = {
+    'console': format_console,
+    'json': format_json
+}
+
+class Listener:
+    def __init__(self, spec):
+        (self.kind, sep, rest) = spec.partition('=')
+        if self.kind not in SERVICE_POLICY or not sep or not rest:
+            raise ValueError('Bad listener "{0:s}" : expected {1:s}=PORT[,option=value...]'.format(spec, '|'.join(SERVICE_POLICY)))
+        options = rest.split(',')
+        self.port = int(options[0], 0)
+        self.queue = SERVICE_QUEUE
+        self.policy = SERVICE_POLICY[self.kind]
+        for option in options[1:]:
+            (name, sep, value) = option.partition('=')
+            if name == 'queue':
+                self.queue = int(value, 0)
+            elif name == 'policy' and value in ('block', 'oldest', 'newest'):
+                self.policy = value
+            else:
+                raise ValueError('Bad listener option "{0:s}"'.format(option))
+
+class Subscriber:
+    def __init__(self, listener, writer):
+        self.kind = listener.kind
+        self.policy = listener.policy
+        self.queue = asyncio.Queue(listener.queue)
+        self.writer = writer
+        self.peer = writer.get_extra_info('peername')
+        self.batches = 0
+        self.dropped = 0
+        self.lag = 0.0 # worst delivery lag in the current metrics interval
+        self.closed = False
+
+    async def publish(self, when, blob):
+        # Queue a batch (tagged with the arrival time of the chunk it
+        # was decoded from) applying the drop policy when full
+        if self.closed:
+            return
+        item = (when, blob)
+        if self.policy == 'block':
+            await self.queue.put(item)
+            return
+        if self.queue.full():
+            self.dropped += 1
+            if self.policy == 'newest':
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait(item)
+
+    async def run(self):
+        try:
+            while True:
+                item = await self.queue.get()
+                if item is None:
+                    break
+                (when, blob) = item
+                self.writer.write(blob)
+                await self.writer.drain()
+                self.batches += 1
+                self.lag = max(self.lag, time.monotonic() - when)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            # Nothing will read the queue again, so empty it to release
+            # a publisher blocked on it (and publish() now ignores us):
+            self.closed = True
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.writer.close()
+
+    def stats(self):
+        stats = {'kind': self.kind, 'peer': str(self.peer), 'queued': self.queue.qsize(), 'batches': self.batches, 'dropped': self.dropped, 'lag': self.lag}
+        self.lag = 0.0
+        return stats
+
+#------------------------------------------------------------------------------
+# Service
+
+class SWOService:
+    def __init__(self, decoder, listeners, interval=1.0, verbose=False, backlog=SERVICE_BACKLOG):
+        self.decoder = decoder
+        self.listeners = listeners
+        self.interval = interval
+        self.verbose = verbose
+        self.subscribers = []
+        self.servers = []
+        self.started = None
+        # Source data waiting to be decoded: (chunk, arrival time) with
+        # a byte count in place of a chunk for dropped data, and None
+        # marking the end of the source:
+        self.pending = collections.deque()
+        self.ready = None
+        self.backlog_limit = backlog
+        self.backlog = 0
+        self.dropped = 0
+        # Latest decoder status:
+        self.status = {}
+        # Metrics for the current interval:
+        self.reported = time.monotonic()
+        self.nbytes = 0
+        self.nframes = 0
+        self.overrun = 0
+        self.decode_time = 0.0
+        self.lag = 0.0
+
+    async def publish(self, kind, when, blob):
+        for sub in [sub for sub in self.subscribers if sub.kind == kind and not sub.closed]:
+            await sub.publish(when, blob)
+
+    async def attach(self, listener, reader, writer):
+        sub = Subscriber(listener, writer)
+        self.subscribers.append(sub)
+        try:
+            await sub.run()
+        finally:
+            self.subscribers.remove(sub)
+
+    async def listen(self):
+        for listener in self.listeners:
+            handler = (lambda r, w, listener=listener: self.attach(listener, r, w))
+            self.servers.append(await asyncio.start_server(handler, 'localhost', listener.port))
+
+    def enqueue(self, chunk, when):
+        # Queues source data for decoding. A chunk that would take the
+        # backlog past its limit is dropped (the source must keep being
+        # read, since a live probe port would otherwise drop data
+        # without telling anyone) and only its size is queued, so that
+        # the decoder reports the gap in order. Returns False if the
+        # chunk was dropped.
+        if self.backlog + len(chunk) > self.backlog_limit:
+            self.overrun += len(chunk)
+            self.dropped += len(chunk)
+            if self.pending and isinstance(self.pending[-1][0], int):
+                (nbytes, first) = self.pending[-1]
+                self.pending[-1] = ((nbytes + len(chunk)), first)
+            else:
+                self.pending.append( (len(chunk), when) )
+            return False
+        self.backlog += len(chunk)
+        self.pending.append( (chunk, when) )
+        return True
+
+    def dequeue(self):
+        # Returns the next batch to decode: consecutive queued chunks
+        # (up to SERVICE_BATCH bytes) joined together, a dropped byte
+        # count, or None at the end of the source
+        (chunk, when) = self.pending.popleft()
+        if chunk is None or isinstance(chunk, int):
+            return (chunk, when)
+        parts = [chunk]
+        size = len(chunk)
+        while self.pending:
+            part = self.pending[0][0]
+            if part is None or isinstance(part, int) or (size + len(part)) > SERVICE_BATCH:
+                break
+            self.pending.popleft()
+            parts.append(part)
+            size += len(part)
+        self.backlog -= size
+        return (b''.join(parts), when)
+
+    async def read_source(self, reader):
+        # Reads the source as fast as it delivers, independently of the
+        # decoding
+        try:
+            while True:
+                chunk = await reader.read(SERVICE_CHUNK)
+                if not chunk:
+                    break
+                when = time.monotonic()
+                if self.started is None:
+                    self.started = when
+                self.enqueue(chunk, when)
+                self.ready.set()
+        finally:
+            self.pending.append( (None, time.monotonic()) )
+            self.ready.set()
+
+    async def consume(self):
+        # Batches are decoded one at a time (so still in order) by the
+        # decoder's worker, leaving the event loop free to read ahead
+        # from the source and to service the subscribers.
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.pending:
+                self.ready.clear()
+                await self.ready.wait()
+            (chunk, when) = self.dequeue()
+            if chunk is None:
+                break
+            kinds = set(sub.kind for sub in self.subscribers)
+            begun = time.monotonic()
+            (nframes, blobs, self.status) = await self.decoder.run(loop, chunk, when - self.started, kinds)
+            done = time.monotonic()
+            if not isinstance(chunk, int):
+                self.nbytes += len(chunk)
+            self.nframes += nframes
+            self.decode_time += (done - begun)
+            self.lag = max(self.lag, done - when)
+            for (kind, blob) in blobs.items():
+                await self.publish(kind, when, blob)
+
+    def metrics(self):
+        now = time.monotonic()
+        elapsed = max(now - self.reported, 1e-9)
+        metrics = {
+            'bytes': self.nbytes,
+            'frames': self.nframes,
+            'rate': (self.nbytes / elapsed),
+            'load': (self.decode_time / elapsed),
+            'lag': self.lag,
+            'backlog': self.backlog,
+            'overrun': self.overrun,
+            'dropped': self.dropped,
+            'errors': self.status.get('errors', 0),
+            'subscribers': [sub.stats() for sub in self.subscribers]
+        }
+        if self.status.get('stream_time') and self.started is not None:
+            metrics['stream_lag'] = ((now - self.started) - self.status['stream_time'])
+        for key in ('tpiu_frames', 'tpiu_idle', 'tpiu_bad_bytes'):
+            if key in self.status:
+                metrics[key] = self.status[key]
+        self.reported = now
+        self.nbytes = 0
+        self.nframes = 0
+        self.overrun = 0
+        self.decode_time = 0.0
+        self.lag = 0.0
+        return metrics
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            metrics = self.metrics()
+            line = json.dumps(metrics) + '\n'
+            if self.verbose:
+                sys.stderr.write(line)
+            await self.publish('metrics', time.monotonic(), line.encode())
+
+    async def serve(self, reader):
+        # Decode the source until it is closed, and then let the
+        # subscribers catch up with the final batches
+        self.ready = asyncio.Event()
+        reporter = asyncio.ensure_future(self.report())
+        source = asyncio.ensure_future(self.read_source(reader))
+        try:
+            await self.consume()
+            # Any source read error:
+            await source
+        finally:
+            source.cancel()
+            reporter.cancel()
+            for server in self.servers:
+                server.close()
+                await server.wait_closed()
+        for sub in list(self.subscribers):
+            if not sub.closed:
+                await sub.queue.put(None)
+        while self.subscribers:
+            await asyncio.sleep(0.01)
+
+async def open_source(source):
+    # Returns (reader, closer) for a "tcp:HOST:PORT" source or a pipe.
+    # The closer (the StreamWriter or pipe transport) must be held for
+    # the whole session, since the connection is closed when it is
+    # garbage collected, and passed to close_source() at the end.
+    if source.startswith('tcp:'):
+        (host, sep, port) = source[4:].rpartition(':')
+        return await asyncio.open_connection(host or 'localhost', int(port, 0))
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=(4 * SERVICE_CHUNK))
+    if source == '-':
+        pipe = sys.stdin.buffer
+    else:
+        pipe = open(source, 'rb', buffering=0)
+    (transport, protocol) = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return (reader, transport)
+
+async def close_source(closer):
+    closer.close()
+    if isinstance(closer, asyncio.StreamWriter):
+        try:
+            await closer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+#------------------------------------------------------------------------------
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Decode a live ITM/DWT SWO stream for local subscribers')
+    parser.add_argument('--source', required=True, help='tcp:HOST:PORT, pipe path or - for stdin')
+    parser.add_argument('--listen', action='append', default=[], help='KIND=PORT[,option=value...]')
+    parser.add_argument('--baud', type=float, default=0, help='SWO baud rate (for stream timestamps)')
+    parser.add_argument('--style', choices=[ds.name for ds in DecodeStyle], default='All')
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--stream', type=int, default=0, help='TPIU stream (0 for BYPASS)')
+    parser.add_argument('--offset', type=int, default=0, help='TPIU initial offset')
+    parser.add_argument('--hold-ms', type=float, default=0, help='maximum hold time of partial output')
+    parser.add_argument('--window-ms', type=float, default=0, help='summary window')
+    parser.add_argument('--search', default='', help='comma separated console search patterns (prefix "re:" for a regex)')
+    parser.add_argument('--postcnt-period', type=int, default=0, help='CPU cycles per DWT POSTCNT wrap (for Counters)')
+    parser.add_argument('--backlog', type=int, default=SERVICE_BACKLOG, help='source bytes queued for decoding before data is dropped')
+    parser.add_argument('--process', action='store_true', help='decode in a worker process (given a spare CPU)')
+    parser.add_argument('--interval', type=float, default=1.0, help='metrics interval in seconds')
+    parser.add_argument('--verbose', action='store_true', help='also write metrics to stderr')
+    args = parser.parse_args(argv)
+
+    try:
+        listeners = [Listener(spec) for spec in args.listen]
+    except ValueError as ex:
+        parser.error(str(ex))
+    dstyle = DecodeStyle[args.style]
+    search = [p.strip() for p in args.search.split(',') if p.strip()]
+    options = (dstyle, args.port, args.stream, args.offset, args.baud, (args.hold_ms / 1000.0), (args.window_ms / 1000.0), search, args.postcnt_period)
+    try:
+        # Also checks the options before starting any worker:
+        decoder = LiveDecoder(*options)
+    except (re.error, ValueError) as ex:
+        parser.error('Bad search pattern: {0:s}'.format(str(ex)))
+    if args.process:
+        decoder = DecodeProcess(*options)
+    service = SWOService(decoder, listeners, args.interval, args.verbose, args.backlog)
+
+    async def run():
+        await service.listen()
+        (reader, closer) = await open_source(args.source)
+        try:
+            await service.serve(reader)
+        finally:
+            await close_source(closer)
+            decoder.close()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
+
+#------------------------------------------------------------------------------
+#> EOF swoservice.py
@@ -0,0 +1,75 @@
+# Regression tests for ITM/DWT resynchronisation after framing errors
+# and bad SYNC packets.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debug import DecodeStyle, PktCtx
+
+def packets(count):
+    # Port 1 4-byte packets with 0x00 payload bytes, interleaved with
+    # port 0 1-byte packets
+    stream = []
+    for idx in range(count):
+        stream += [0x0B, 0x00, idx, 0x00, 0x00]
+        stream += [0x01, 0x41 + idx]
+    return stream
+
+def decode(stream, errors=()):
+    ctx = PktCtx(None, DecodeStyle.All, 0)
+    frames = []
+    for (idx, db) in enumerate(stream):
+        if idx in errors:
+            nf = ctx.error_byte(float(idx), idx + 0.5)
+        else:
+            nf = ctx.run_byte(db, float(idx), idx + 0.5)
+        if nf is None:
+            continue
+        frames += nf if isinstance(nf, list) else [nf]
+    return frames
+
+def values(frames, ftype):
+    return [nf.data['val'] for nf in frames if nf.type == ftype]
+
+class ResyncTest(unittest.TestCase):
+    def test_zero_payload_does_not_end_hunt(self):
+        # After a framing error the 0x00 payload bytes must not be taken
+        # as the start of a SYNC (which would then fail as a BadSync and
+        # leave the decoder misaligned)
+        stream = packets(20)
+        frames = decode(stream, errors=(15,))
+        errors = values(frames, 'err')
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('Framing error: lost '))
+        clean = values(decode(stream), 'itm')
+        self.assertEqual(values(frames, 'itm')[-30:], clean[-30:])
+
+    def test_full_sync_ends_hunt(self):
+        stream = packets(2) + [0x0B, 0x12] + [0x00] * 5 + [0x80] + packets(2)
+        frames = decode(stream, errors=(15,))
+        self.assertEqual(values(frames, 'err'), ['Framing error: lost 2 bytes'])
+        self.assertEqual(values(frames, 'console')[-1:], ['SYNC'])
+        self.assertEqual(values(frames, 'itm')[-4:], values(decode(packets(2)), 'itm'))
+
+    def test_long_sync(self):
+        frames = decode([0x00] * 7 + [0x80] + packets(1))
+        self.assertEqual(values(frames, 'err'), [])
+        self.assertEqual(values(frames, 'console'), ['SYNC'])
+
+    def test_bad_sync_hunts(self):
+        # A stray 0x00 at a header position is reported as a BadSync,
+        # and decoding then resumes at the next plausible header rather
+        # than at the following payload byte
+        stream = packets(3) + [0x00, 0x12, 0x00, 0x34] + packets(10)
+        frames = decode(stream)
+        errors = values(frames, 'err')
+        self.assertEqual(errors[0], 'BadSync: Expected 00 saw 12')
+        self.assertEqual(errors[1], 'BadSync: lost 3 bytes')
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(values(frames, 'itm'), values(decode(packets(3) + packets(10)), 'itm'))
+
+if __name__ == '__main__':
+    unittest.main()
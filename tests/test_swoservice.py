@@ -0,0 +1,152 @@
+# Live decoding service tests, streaming the source over a real TCP
+# socket as from a debug probe SWO port.
+
+import asyncio
+import gc
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from debug import DecodeStyle
+from swoservice import DecodeProcess, Listener, LiveDecoder, SWOService, close_source, open_source
+
+LINE = b'hello world 0123456789\n'
+LINES = 2000
+
+def console_stream():
+    # Port 0 1-byte ITM packets
+    return b''.join(bytes([0x01, cc]) for cc in LINE) * LINES
+
+class SocketSourceTest(unittest.TestCase):
+    def test_tcp_source(self):
+        asyncio.run(self.tcp_source())
+
+    async def tcp_source(self):
+        data = console_stream()
+
+        async def feeder(reader, writer):
+            for lo in range(0, len(data), 4096):
+                writer.write(data[lo:lo + 4096])
+                await writer.drain()
+                await asyncio.sleep(0)
+            writer.close()
+
+        feed_server = await asyncio.start_server(feeder, 'localhost', 0)
+        feed_port = feed_server.sockets[0].getsockname()[1]
+
+        listener = Listener('console=0')
+        service = SWOService(LiveDecoder(DecodeStyle.Console), [listener], interval=0.1)
+        await service.listen()
+        console_port = service.servers[0].sockets[0].getsockname()[1]
+
+        output = []
+
+        async def client():
+            (reader, writer) = await asyncio.open_connection('localhost', console_port)
+            while True:
+                blob = await reader.read(65536)
+                if not blob:
+                    break
+                output.append(blob)
+            writer.close()
+
+        consumer = asyncio.ensure_future(client())
+        while not service.subscribers:
+            await asyncio.sleep(0.01)
+
+        (reader, closer) = await open_source('tcp:localhost:{0:d}'.format(feed_port))
+        # The connection must survive the collection of any temporary
+        # references:
+        gc.collect()
+        try:
+            await asyncio.wait_for(service.serve(reader), 60)
+        finally:
+            await close_source(closer)
+            feed_server.close()
+            await feed_server.wait_closed()
+        await asyncio.wait_for(consumer, 10)
+
+        lines = b''.join(output).splitlines()
+        self.assertEqual(service.decoder.nbytes, len(data))
+        self.assertEqual(len(lines), LINES)
+        self.assertTrue(all(line.endswith(b'console hello world 0123456789') for line in lines))
+
+class DecodeProcessTest(unittest.TestCase):
+    def test_same_output(self):
+        asyncio.run(self.same_output())
+
+    async def same_output(self):
+        data = console_stream()[:4600]
+        expected = LiveDecoder(DecodeStyle.Console).decode(data, 1.0, ('console', 'json'))
+        decoder = DecodeProcess(DecodeStyle.Console)
+        try:
+            result = await asyncio.wait_for(decoder.run(asyncio.get_running_loop(), data, 1.0, ('console', 'json')), 60)
+        finally:
+            decoder.close()
+        self.assertEqual(result, expected)
+        self.assertEqual(result[0], 100)
+
+def tpiu_frames(data, stream=1):
+    # TPIU formatted frames carrying data for a single stream
+    data = list(data)
+    data += [0x00] * (-len(data) % 14)
+    out = []
+    for lo in range(0, len(data), 14):
+        chunk = data[lo:lo + 14]
+        frame = [((stream << 1) | 1), chunk[0]]
+        lsbits = 0
+        for idx in range(6):
+            frame += [(chunk[1 + (2 * idx)] & 0xFE), chunk[2 + (2 * idx)]]
+            lsbits |= ((chunk[1 + (2 * idx)] & 1) << (idx + 1))
+        frame.append(chunk[13] & 0xFE)
+        lsbits |= ((chunk[13] & 1) << 7)
+        frame.append(lsbits)
+        out += frame
+    return bytes(out)
+
+class OverrunTest(unittest.TestCase):
+    def test_backlog_limit(self):
+        service = SWOService(LiveDecoder(DecodeStyle.Console), [], backlog=100)
+        self.assertTrue(service.enqueue(b'a' * 60, 1.0))
+        self.assertFalse(service.enqueue(b'b' * 60, 2.0))
+        self.assertFalse(service.enqueue(b'c' * 50, 3.0))
+        self.assertTrue(service.enqueue(b'd' * 40, 4.0))
+        self.assertEqual(service.dropped, 110)
+        # Dropped chunks are merged, and report the gap in order:
+        self.assertEqual(service.dequeue(), (b'a' * 60, 1.0))
+        self.assertEqual(service.dequeue(), (110, 2.0))
+        self.assertEqual(service.dequeue(), (b'd' * 40, 4.0))
+        self.assertEqual(service.backlog, 0)
+
+    def test_bypass_gap(self):
+        decoder = LiveDecoder(DecodeStyle.Console)
+        frames = decoder.feed(console_stream()[:460], 0.0)
+        frames += decoder.skip(1000, 1.0)
+        frames += decoder.feed(console_stream()[:460], 2.0)
+        errs = [nf.data['val'] for nf in frames if nf.type == 'err']
+        lines = [nf.data['val'] for nf in frames if nf.type == 'console']
+        self.assertEqual(errs, ['Overrun: 1000 bytes dropped (total 1000)'])
+        self.assertEqual(len(lines), 20)
+        self.assertEqual(decoder.nbytes, 1920)
+
+    def test_tpiu_gap(self):
+        # A gap that is not a whole number of TPIU frames must leave the
+        # decoder aligned with the frames that follow
+        raw = tpiu_frames(console_stream()[:2300])
+        decoder = LiveDecoder(DecodeStyle.Console, stream=1)
+        frames = decoder.feed(raw[:800], 0.0)
+        frames += decoder.skip(405, 1.0)
+        frames += decoder.feed(raw[1205:], 2.0)
+        errs = [nf.data['val'] for nf in frames if nf.type == 'err']
+        lines = [nf.data['val'] for nf in frames if nf.type == 'console']
+        self.assertEqual(errs[0], 'Overrun: 405 bytes dropped (total 405)')
+        self.assertTrue(all(err.startswith('Overrun') for err in errs))
+        self.assertEqual(decoder.tpiu.bad_bytes, 0)
+        # Whole lines either side of the gap are intact:
+        self.assertTrue(len(lines) >= 40)
+        self.assertEqual(sum(1 for line in lines if line == 'hello world 0123456789'), len(lines) - 1)
+
+if __name__ == '__main__':
+    unittest.main()